@@ -1,24 +1,135 @@
 #!/usr/bin/env python3
 """Charm code for https://github.com/canonical/gh-jira-sync-bot."""
+import hashlib
+import json
 import logging
+import math
 import os
+import pathlib
+import re
+import shlex
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 import ops
+import yaml
 from charms.loki_k8s.v1.loki_push_api import LogForwarder
 from charms.nginx_ingress_integrator.v0.nginx_route import require_nginx_route
 from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
 from charms.redis_k8s.v0.redis import RedisRelationCharmEvents, RedisRequires
+from lightkube import ApiError, Client, ConfigError
+from lightkube.resources.apps_v1 import StatefulSet
+from lightkube.resources.core_v1 import Pod
+from lightkube.types import PatchType
+from lightkube.utils.quantity import equals_canonically, parse_quantity
 
 logger = logging.getLogger(__name__)
 
+APP_MODULE = "github_jira_sync_app.main:app"
+WORKLOAD_CONTAINER = "gh-jira-bot"
+SERVICE_NAME = "gh-jira-bot-service"
+METRICS_SERVICE_NAME = "gh-jira-bot-metrics"
+WORKER_SERVICE_NAME = "gh-jira-bot-worker"
+WORKER_MODULE = "github_jira_sync_app.worker"
+INGESTION_MODES = ("sync", "queue")
+# Options of features that only work with state shared in Redis; 0 disables them.
+REDIS_OPTIONS = (
+    "dedup-ttl",
+    "token-cache-margin",
+    "local-cache-max-entries",
+    "debounce-window",
+    "retry-max-attempts",
+    "github-rate-limit",
+    "jira-rate-limit",
+    "ownership-vnodes",
+)
+FAIR_SCHEDULING_KEYS = ("off", "repository", "installation")
+DEFAULT_LANE = "default"
+DEFAULT_LANE_SHARE = 1
+EVENT_PATTERN = re.compile(r"[a-z_]+(\.[a-z_]+)?")
+REPOSITORY_PATTERN = re.compile(r"[\w.-]+/[\w.-]+")
+ISSUE_INDEX_MODULE = "github_jira_sync_app.issue_index"
+JIRA_METADATA_CATEGORIES = ("project", "issue-type", "field", "component", "transition")
+# Lifetime in seconds of the GitHub App installation access tokens.
+INSTALLATION_TOKEN_LIFETIME = 3600
+HASH_RING_FILE = "/etc/gh-jira-bot/hash-ring.json"
+REDIS_ADMIN = "/etc/gh-jira-bot/redis_admin.py"
+REDIS_ADMIN_SOURCE = pathlib.Path(__file__).parent / "redis_admin.py"
+REDIS_ADMIN_ENVIRONMENT = ("REDIS_HOST", "REDIS_PORT", "REDIS_KEY_PREFIX")
+READINESS_CHECK = "gh-jira-bot-ready"
+LIVENESS_CHECK = "gh-jira-bot-alive"
+# The liveness check runs this many times less often than the readiness check.
+LIVENESS_PERIOD_FACTOR = 3
+PEER_RELATION = "cluster"
+UVICORN_LOOPS = ("auto", "asyncio", "uvloop")
+UVICORN_HTTP_PARSERS = ("auto", "h11", "httptools")
+
+CREDENTIALS_DIR = "/etc/gh-jira-bot"
+# Environment variable (or file name, lowercased) holding each option in the workload.
+CREDENTIAL_OPTIONS = {
+    "PRIVATE_KEY": "private-key",
+    "WEBHOOK_SECRET": "webhook-secret",
+    "JIRA_TOKEN": "jira-token",
+    "DEFAULT_BOT_CONFIG": "bot-config",
+}
+RELOAD_SIGNAL = "SIGHUP"
+# Kubernetes (kind, resource) of the workload container set by each option.
+RESOURCE_OPTIONS = {
+    ("requests", "cpu"): "cpu-request",
+    ("limits", "cpu"): "cpu-limit",
+    ("requests", "memory"): "memory-request",
+    ("limits", "memory"): "memory-limit",
+}
+
+# tmpfs in every container, so multiprocess metric files never hit the disk.
+METRICS_MULTIPROC_DIR = "/dev/shm/gh-jira-bot-metrics"
+WORKER_METRICS_MULTIPROC_DIR = "/dev/shm/gh-jira-bot-worker-metrics"
+GUNICORN_CONFIG = "/etc/gh-jira-bot/gunicorn.conf.py"
+GUNICORN_CONFIG_SOURCE = pathlib.Path(__file__).parent / "gunicorn.conf.py"
+METRICS_SERVER = "/etc/gh-jira-bot/metrics_server.py"
+METRICS_SERVER_SOURCE = pathlib.Path(__file__).parent / "metrics_server.py"
+
+# Worker count of workers=auto when the workload container has no CPU quota.
+AUTO_WORKERS_FALLBACK = 2
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def ring_hash(key: str) -> int:
+    """Position of `key` on the consistent-hash ring: the first 64 bits of its SHA-256."""
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class InvalidConfigError(Exception):
+    """Raised when the charm configuration cannot be applied."""
+
+
+class WorkloadCommandError(Exception):
+    """Raised when a command run in the workload container fails."""
+
 
 class GitHubJiraBotCharm(ops.CharmBase):
     """Charm class for https://github.com/canonical/gh-jira-sync-bot."""
 
     on = RedisRelationCharmEvents()
+    _stored = ops.StoredState()
+    # cpu-limit, worker count and whether no quota was found, for workers=auto.
+    _auto_workers: Optional[Tuple[str, int, bool]] = None
 
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(
+            layer_hash="",
+            files_hash="",
+            restarts=0,
+            skipped_restarts=0,
+            reloads=0,
+            resources_patched=False,
+            effective_resources="",
+            recommended_units=0,
+            recommended_at=0.0,
+        )
 
         require_nginx_route(
             charm=self,
@@ -36,11 +147,12 @@ class GitHubJiraBotCharm(ops.CharmBase):
                 {
                     "job_name": self.model.app.name,
                     "metrics_path": "/metrics",
-                    "static_configs": [{"targets": [f"*:{self.config['port']}"]}],
+                    "static_configs": [{"targets": [f"*:{self._metrics_port}"]}],
                     "scrape_interval": "30s",
                     "scrape_timeout": "10s",
                 }
             ],
+            refresh_event=[self.on.gh_jira_bot_pebble_ready, self.on.config_changed],
         )
 
         self._log_forwarder = LogForwarder(charm=self)
@@ -48,35 +160,574 @@ class GitHubJiraBotCharm(ops.CharmBase):
         self.framework.observe(self.on.gh_jira_bot_pebble_ready, self._on_config_changed)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.redis_relation_updated, self._on_config_changed)
+        self.framework.observe(self.on.get_restart_stats_action, self._on_get_restart_stats)
+        self.framework.observe(self.on.dead_letters_list_action, self._on_dead_letters_list)
+        self.framework.observe(self.on.dead_letters_requeue_action, self._on_dead_letters_requeue)
+        self.framework.observe(self.on.dead_letters_purge_action, self._on_dead_letters_purge)
+        self.framework.observe(
+            self.on.get_scaling_recommendation_action, self._on_get_scaling_recommendation
+        )
+        self.framework.observe(
+            self.on.invalidate_jira_cache_action, self._on_invalidate_jira_cache
+        )
+        self.framework.observe(self.on.rebuild_issue_index_action, self._on_rebuild_issue_index)
+        self.framework.observe(
+            self.on[PEER_RELATION].relation_changed, self._on_restart_lock_changed
+        )
+        self.framework.observe(
+            self.on[PEER_RELATION].relation_departed, self._on_restart_lock_changed
+        )
+        self.framework.observe(self.on.leader_elected, self._on_restart_lock_changed)
+        # The ready check recovers once a restarted server answers again.
+        self.framework.observe(
+            self.on.gh_jira_bot_pebble_check_recovered, self._on_restart_lock_changed
+        )
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        for event in (
+            self.on[PEER_RELATION].relation_joined,
+            self.on[PEER_RELATION].relation_changed,
+            self.on[PEER_RELATION].relation_departed,
+            self.on.leader_elected,
+        ):
+            self.framework.observe(event, self._on_ring_changed)
 
     def _on_config_changed(self, event: ops.ConfigChangedEvent):
         self._handle_ports()
 
         container = self.unit.get_container("gh-jira-bot")
         if container.can_connect():
-            # Push an updated layer with the new config
-            container.add_layer("gh_jira_bot", self._pebble_layer, combine=True)
-            container.replan()
+            try:
+                self._apply_resources()
+                workers = self._workers
+                layer = self._pebble_layer
+                self._check_restart_options()
+                self._check_autoscale_options()
+            except InvalidConfigError as e:
+                self.unit.status = ops.BlockedStatus(str(e))
+                return
 
-            self.unit.status = ops.ActiveStatus()
+            if self.unit.is_leader() and not self.config["autoscale-max-units"]:
+                self._reset_autoscaling()
+            self._push_server_files(container)
+            self._push_hash_ring(container)
+            files_changed = self._push_credential_files(container)
+            # A pebble-ready event means the workload container (re)started with an empty plan.
+            if (
+                not isinstance(event, ops.PebbleReadyEvent)
+                and self._layer_hash(layer) == self._stored.layer_hash
+                and SERVICE_NAME in container.get_plan().services
+            ):
+                if files_changed:
+                    # Credentials are read from files: ask the running server to reload them.
+                    self._reload_services(container)
+                else:
+                    logger.debug("Pebble layer unchanged, skipping replan")
+                    self._stored.skipped_restarts += 1
+            elif not isinstance(event, ops.PebbleReadyEvent) and self._needs_restart_lock:
+                # Other units are serving webhooks: restart when the leader lets us.
+                self._peer_data["restart"] = "requested"
+                self.unit.status = ops.WaitingStatus("Waiting for restart lock")
+                self._process_restart_lock()
+                return
+            else:
+                self._replan(container, layer)
+
+            self.unit.status = self._active_status(workers)
+            self._publish_serving(container)
         else:
             # We were unable to connect to the Pebble API, so we defer this event
             event.defer()
             self.unit.status = ops.WaitingStatus("Waiting for Pebble API")
 
+    def _active_status(self, workers: int) -> ops.ActiveStatus:
+        message = f"workers: {workers}"
+        if self._auto_workers and self._auto_workers[2]:
+            message += " (no CPU quota)"
+        if self._stored.effective_resources:
+            message += f", {self._stored.effective_resources}"
+        return ops.ActiveStatus(message)
+
+    @property
+    def _resource_requirements(self) -> Dict[str, Dict[str, str]]:
+        """Requests and limits of the workload container, from the resource options."""
+        resources: Dict[str, Dict[str, str]] = {"requests": {}, "limits": {}}
+        for (kind, resource), option in RESOURCE_OPTIONS.items():
+            if value := self.config[option]:
+                try:
+                    parse_quantity(value)
+                except ValueError:
+                    raise InvalidConfigError(f"invalid {option} value: {value!r}")
+                resources[kind][resource] = value
+        for resource in ("cpu", "memory"):
+            request = resources["requests"].get(resource)
+            limit = resources["limits"].get(resource)
+            if request and limit and parse_quantity(request) > parse_quantity(limit):
+                raise InvalidConfigError(f"{resource}-request exceeds {resource}-limit")
+        return resources
+
+    def _apply_resources(self):
+        """Patch the StatefulSet with the configured resources and record the effective ones.
+
+        Nothing is sent to the Kubernetes API until a resource option has been set once, so
+        deployments that do not use them keep working without `juju trust`.
+        """
+        resources = self._resource_requirements
+        if not any(resources.values()) and not self._stored.resources_patched:
+            return
+        try:
+            client = Client(field_manager=self.app.name)
+            if self.unit.is_leader():
+                self._patch_statefulset(client, resources)
+            pod = client.get(Pod, name=self.unit.name.replace("/", "-"), namespace=self.model.name)
+        except (ApiError, ConfigError) as e:
+            logger.error("Unable to apply resource requirements: %s", e)
+            raise InvalidConfigError("Unable to patch resources, run `juju trust` on this app")
+        self._stored.resources_patched = True
+
+        effective = next(c.resources for c in pod.spec.containers if c.name == WORKLOAD_CONTAINER)
+        self._stored.effective_resources = ", ".join(
+            f"{resource}: {(effective.requests or {}).get(resource, '-')}"
+            f"/{(effective.limits or {}).get(resource, '-')}"
+            for resource in ("cpu", "memory")
+        )
+
+    def _patch_statefulset(self, client: Client, resources: Dict[str, Dict[str, str]]):
+        statefulset = client.get(StatefulSet, name=self.app.name, namespace=self.model.name)
+        current = next(
+            c.resources
+            for c in statefulset.spec.template.spec.containers
+            if c.name == WORKLOAD_CONTAINER
+        )
+        if all(
+            equals_canonically(getattr(current, kind) or {}, resources[kind])
+            for kind in ("requests", "limits")
+        ):
+            return
+        # Keys set to None are removed by the strategic merge patch.
+        patch = {
+            kind: {resource: resources[kind].get(resource) for resource in ("cpu", "memory")}
+            for kind in ("requests", "limits")
+        }
+        logger.info("Patching resources of the %s container: %s", WORKLOAD_CONTAINER, patch)
+        client.patch(
+            StatefulSet,
+            name=self.app.name,
+            namespace=self.model.name,
+            obj={
+                "spec": {
+                    "template": {
+                        "spec": {"containers": [{"name": WORKLOAD_CONTAINER, "resources": patch}]}
+                    }
+                }
+            },
+            patch_type=PatchType.STRATEGIC,
+        )
+
+    def _reload_services(self, container: ops.Container):
+        """Ask the running services to re-read their credential files."""
+        services = [SERVICE_NAME]
+        if self.config["ingestion-mode"] == "queue":
+            services.append(WORKER_SERVICE_NAME)
+        try:
+            container.send_signal(RELOAD_SIGNAL, *services)
+            self._stored.reloads += 1
+        except ops.pebble.APIError as e:
+            # Not running: the files are read when Pebble starts them again.
+            logger.warning("Unable to signal %s: %s", ", ".join(services), e)
+
+    @staticmethod
+    def _layer_hash(layer) -> str:
+        return hashlib.sha256(json.dumps(layer, sort_keys=True).encode()).hexdigest()
+
+    def _replan(self, container: ops.Container, layer):
+        # Push an updated layer with the new config
+        container.add_layer("gh_jira_bot", layer, combine=True)
+        container.replan()
+        self._remove_unused_credential_files(container)
+        self._stored.layer_hash = self._layer_hash(layer)
+        self._stored.restarts += 1
+
+    @property
+    def _peer_data(self) -> ops.RelationDataContent:
+        relation = self.model.get_relation(PEER_RELATION)
+        assert relation is not None
+        return relation.data[self.unit]
+
+    @property
+    def _needs_restart_lock(self) -> bool:
+        """Whether a replan must wait for the peer restart lock."""
+        relation = self.model.get_relation(PEER_RELATION)
+        return relation is not None and len(relation.units) > 0
+
+    def _on_restart_lock_changed(self, _: ops.EventBase):
+        try:
+            self._process_restart_lock()
+        except InvalidConfigError as e:
+            self.unit.status = ops.BlockedStatus(str(e))
+
+    def _on_update_status(self, _: ops.UpdateStatusEvent):
+        try:
+            self._process_restart_lock()
+            self._update_health_status()
+            container = self.unit.get_container(WORKLOAD_CONTAINER)
+            if container.can_connect():
+                self._publish_serving(container)
+        except InvalidConfigError as e:
+            self.unit.status = ops.BlockedStatus(str(e))
+        if not self.unit.is_leader():
+            return
+        if not self.config["autoscale-max-units"]:
+            self._reset_autoscaling()
+            return
+        try:
+            self._evaluate_autoscaling()
+        except (InvalidConfigError, WorkloadCommandError) as e:
+            logger.warning("Unable to evaluate autoscaling: %s", e)
+            self.app.status = ops.BlockedStatus(f"autoscaling: {e}")
+
+    def _check_autoscale_options(self):
+        if not self.config["autoscale-max-units"]:
+            return
+        if not 1 <= self.config["autoscale-min-units"] <= self.config["autoscale-max-units"]:
+            raise InvalidConfigError(
+                "autoscale-min-units must be between 1 and autoscale-max-units"
+            )
+        down_backlog = self.config["scale-down-backlog"]
+        if not 0 <= down_backlog < self.config["scale-up-backlog"]:
+            raise InvalidConfigError("scale-down-backlog must be below scale-up-backlog")
+        if self.config["scale-up-age"] < 1 or self.config["autoscale-cooldown"] < 0:
+            raise InvalidConfigError(
+                "scale-up-age must be positive and autoscale-cooldown not negative"
+            )
+        if self.config["ingestion-mode"] != "queue":
+            raise InvalidConfigError("autoscaling requires ingestion-mode=queue")
+
+    def _reset_autoscaling(self):
+        """Forget the recommendation of the autoscaling controller and clear its status."""
+        self._stored.recommended_units = 0
+        if self.app.status != ops.ActiveStatus():
+            self.app.status = ops.ActiveStatus()
+
+    def _evaluate_autoscaling(self) -> Dict:
+        """Recommend a unit count from the delivery stream backlog, as the leader.
+
+        The recommendation grows when the backlog per unit or the age of the oldest waiting
+        delivery exceed their scale-up thresholds, and shrinks by one unit at a time when
+        the backlog per unit falls below the scale-down threshold. It changes at most once
+        per `autoscale-cooldown` seconds and is reported in the application status.
+        """
+        self._check_autoscale_options()
+        min_units = self.config["autoscale-min-units"]
+        max_units = self.config["autoscale-max-units"]
+        up_backlog = self.config["scale-up-backlog"]
+        down_backlog = self.config["scale-down-backlog"]
+        stats = self._redis_admin("stream-stats", f"--group={self._consumer_group}")
+        current = self.app.planned_units()
+        per_unit = stats["backlog"] / current
+        recommended = current
+        if per_unit > up_backlog or stats["oldest-age"] > self.config["scale-up-age"]:
+            recommended = max(current + 1, math.ceil(stats["backlog"] / up_backlog))
+        elif per_unit < down_backlog:
+            recommended = current - 1
+        recommended = min(max(recommended, min_units), max_units)
+
+        now = time.time()
+        previous = self._stored.recommended_units
+        if previous and recommended != previous:
+            if now - self._stored.recommended_at < self.config["autoscale-cooldown"]:
+                recommended = previous
+            else:
+                self._stored.recommended_at = now
+        elif not previous:
+            self._stored.recommended_at = now
+        self._stored.recommended_units = recommended
+
+        self.app.status = ops.ActiveStatus(
+            f"recommended units: {recommended} (backlog {stats['backlog']},"
+            f" oldest {stats['oldest-age']:.0f}s)"
+        )
+        return {"current-units": current, "recommended-units": recommended, **stats}
+
+    def _on_get_scaling_recommendation(self, event: ops.ActionEvent):
+        if not self.unit.is_leader():
+            event.fail("This action must run on the leader unit")
+            return
+        if not self.config["autoscale-max-units"]:
+            event.fail("Autoscaling is disabled, set autoscale-max-units")
+            return
+        try:
+            event.set_results(self._evaluate_autoscaling())
+        except (InvalidConfigError, WorkloadCommandError) as e:
+            event.fail(str(e))
+
+    def _process_restart_lock(self):
+        """Act on the restart lock: grant it as leader, restart when granted, release when ready.
+
+        Each unit publishes its own state in the peer unit databag: "requested" once it has
+        a pending layer change, "restarting" after replanning until the Pebble ready checks
+        pass again, and "" when idle. The leader publishes the units allowed to restart in
+        the application databag, with the deadline of each grant, at most
+        `max-parallel-restarts` at a time, and only moves on once a granted unit is back to
+        idle or its deadline has passed.
+        """
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation is None:
+            return
+        if self.unit.is_leader():
+            self._grant_restarts(relation)
+
+        state = relation.data[self.unit].get("restart", "")
+        granted = json.loads(relation.data[self.app].get("restart-granted", "{}"))
+        container = self.unit.get_container(WORKLOAD_CONTAINER)
+        if not container.can_connect():
+            return
+        if state == "requested" and self.unit.name in granted:
+            try:
+                layer = self._pebble_layer
+            except InvalidConfigError as e:
+                self.unit.status = ops.BlockedStatus(str(e))
+                relation.data[self.unit]["restart"] = ""
+                return
+            # Only check runs completed after the replan tell that the new server is ready.
+            relation.data[self.unit]["restart-checks"] = json.dumps(
+                self._ready_check_runs(container)
+            )
+            self._replan(container, layer)
+            relation.data[self.unit]["restart"] = state = "restarting"
+            self.unit.status = ops.MaintenanceStatus("Waiting for the webhook server to be ready")
+            # Give the checks one run, so that a quick restart releases the lock in this hook
+            # rather than at the next update-status.
+            deadline = (
+                time.monotonic() + self.config["check-period"] + self.config["check-timeout"]
+            )
+            while not self._workload_ready(container) and time.monotonic() < deadline:
+                time.sleep(1)
+
+        if state == "restarting" and self._workload_ready(container):
+            relation.data[self.unit]["restart"] = ""
+            relation.data[self.unit]["restart-checks"] = ""
+            self.unit.status = self._active_status(self._workers)
+            self._publish_serving(container)
+            if self.unit.is_leader():
+                self._grant_restarts(relation)
+
+    def _check_restart_options(self):
+        if self.config["restart-lock-timeout"] < 1:
+            raise InvalidConfigError("restart-lock-timeout must be a positive integer")
+
+    def _grant_restarts(self, relation: ops.Relation):
+        self._check_restart_options()
+        timeout = self.config["restart-lock-timeout"]
+        states = {
+            unit.name: relation.data[unit].get("restart", "")
+            for unit in relation.units | {self.unit}
+        }
+        now = time.time()
+        granted = json.loads(relation.data[self.app].get("restart-granted", "{}"))
+        expired = {name for name, deadline in granted.items() if deadline <= now}
+        for name in sorted(expired):
+            logger.warning("%s did not release the restart lock in time, revoking it", name)
+        # Keep the lock for units that have not released it yet.
+        granted = {
+            name: deadline
+            for name, deadline in granted.items()
+            if states.get(name) and name not in expired
+        }
+        for name, state in sorted(states.items()):
+            if len(granted) >= max(1, self.config["max-parallel-restarts"]):
+                break
+            # A unit whose grant just expired lets the others go first.
+            if state == "requested" and name not in granted and name not in expired:
+                granted[name] = now + timeout
+        relation.data[self.app]["restart-granted"] = json.dumps(granted, sort_keys=True)
+
+    def _on_ring_changed(self, event: ops.EventBase):
+        self._update_ring()
+        if not self.unit.is_leader() or not self.config["ownership-vnodes"]:
+            return
+        # A new leader also empties the queue of the previous leader, which departed
+        # without any unit reassigning it.
+        if isinstance(event, ops.LeaderElectedEvent) or (
+            isinstance(event, ops.RelationDepartedEvent)
+            and event.departing_unit not in (None, self.unit)
+        ):
+            self._reassign_handoff_queues(event)
+
+    def _update_ring(self):
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation is None:
+            return
+        if self.unit.is_leader():
+            members = sorted(
+                unit.name
+                for unit in relation.units | {self.unit}
+                if relation.data[unit].get("serving")
+            )
+            relation.data[self.app]["ring-members"] = json.dumps(members)
+        container = self.unit.get_container(WORKLOAD_CONTAINER)
+        if container.can_connect():
+            self._push_hash_ring(container)
+
+    def _publish_serving(self, container: ops.Container):
+        """Tell the leader whether the webhook server passes its ready checks.
+
+        Only units serving webhooks are members of the consistent-hash ring.
+        """
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation is None or not self.config["ownership-vnodes"]:
+            return
+        serving = SERVICE_NAME in container.get_plan().services and all(
+            check.status == ops.pebble.CheckStatus.UP
+            for check in container.get_checks(level=ops.pebble.CheckLevel.READY).values()
+        )
+        relation.data[self.unit]["serving"] = "true" if serving else ""
+        if self.unit.is_leader():
+            self._update_ring()
+
+    def _reassign_handoff_queues(self, event: ops.EventBase):
+        """Move the events queued for departed units to the new owners of their repository."""
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation is None:
+            return
+        departed = getattr(event, "departing_unit", None)
+        members = sorted(unit.name for unit in relation.units | {self.unit} if unit != departed)
+        try:
+            output = self._redis_admin(
+                "handoff-reassign",
+                f"--members={','.join(members)}",
+                f"--ring={HASH_RING_FILE}",
+                f"--fallback={self.unit.name}",
+            )
+        except WorkloadCommandError as e:
+            logger.warning("Unable to reassign the handoff queues of departed units: %s", e)
+            event.defer()
+            return
+        for unit, count in output["reassigned"].items():
+            logger.info("Reassigned %d events queued for %s", count, unit)
+
+    def _push_hash_ring(self, container: ops.Container):
+        """Write the consistent-hash ring assigning repositories to units.
+
+        The leader publishes the ring members in the peer application databag. Each member
+        owns `ownership-vnodes` points on a 64-bit ring; a repository ("owner/name") belongs
+        to the member of the first point at or after the hash of its name, wrapping around.
+        Adding or removing a unit therefore only moves the repositories next to its points.
+        Events for repositories owned by another unit are handed over through that unit's
+        Redis queue, named HANDOFF_QUEUE_PREFIX followed by the unit name, which the leader
+        empties into the queues of the new owners when the unit departs, or, for a departed
+        leader, when the next leader is elected.
+
+        Until the leader publishes the members, or while no unit is serving, the ring has
+        no points and each unit processes every event it receives itself.
+        """
+        vnodes = self.config["ownership-vnodes"]
+        relation = self.model.get_relation(PEER_RELATION)
+        if not vnodes or relation is None:
+            return
+        members = json.loads(relation.data[self.app].get("ring-members", "[]"))
+        points = sorted(
+            (ring_hash(f"{member}#{i}"), member) for member in members for i in range(vnodes)
+        )
+        ring = {"unit": self.unit.name, "hash": "sha256-64", "points": points}
+        container.push(HASH_RING_FILE, json.dumps(ring), make_dirs=True)
+
+    @staticmethod
+    def _ready_check_runs(container: ops.Container) -> Dict[str, List]:
+        """Change ID and number of successful runs of each Pebble ready check."""
+        return {
+            name: [check.change_id or "", getattr(check, "successes", None) or 0]
+            for name, check in container.get_checks(level=ops.pebble.CheckLevel.READY).items()
+        }
+
+    def _workload_ready(self, container: ops.Container) -> bool:
+        """Whether the Pebble ready checks passed again since the restart."""
+        before = json.loads(self._peer_data.get("restart-checks", "{}"))
+        for name, check in container.get_checks(level=ops.pebble.CheckLevel.READY).items():
+            if check.status != ops.pebble.CheckStatus.UP:
+                return False
+            successes = getattr(check, "successes", None)
+            if successes is None:
+                # Pebble versions not counting successes only report the status.
+                continue
+            change_id, count = before.get(name, ["", 0])
+            # Pebble restarts a check whose definition changed, counting from zero again.
+            restarted = (check.change_id or "") != change_id or successes < count
+            if successes <= (0 if restarted else count):
+                return False
+        return True
+
+    def _on_get_restart_stats(self, event: ops.ActionEvent):
+        event.set_results(
+            {
+                "restarts": self._stored.restarts,
+                "skipped-restarts": self._stored.skipped_restarts,
+                "reloads": self._stored.reloads,
+            }
+        )
+
+    @property
+    def _credential_files(self) -> Dict[str, str]:
+        """Content of the files holding credentials and bot config, keyed by environment variable."""
+        return {
+            env_var: self.config[option]
+            for env_var, option in CREDENTIAL_OPTIONS.items()
+            if self.config[option]
+        }
+
+    def _push_credential_files(self, container: ops.Container) -> bool:
+        """Push credentials and bot config into the workload container.
+
+        The files are checked one by one rather than through the stored hash alone: other
+        files live in the same directory, and a restarted container starts without any.
+        Files no longer used are only removed by `_replan`, once no service refers to them.
+
+        Returns whether the content of the files changed.
+        """
+        if not self.config["credentials-as-files"]:
+            # Without files, the credentials are in the layer and a change replans instead.
+            return False
+        files = self._credential_files
+        files_hash = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+        if files_hash == self._stored.files_hash and all(
+            container.exists(self._credential_path(env_var)) for env_var in files
+        ):
+            return False
+
+        for env_var, content in files.items():
+            container.push(
+                self._credential_path(env_var), content, make_dirs=True, permissions=0o600
+            )
+        self._stored.files_hash = files_hash
+        return True
+
+    def _remove_unused_credential_files(self, container: ops.Container):
+        """Remove the credential files that the replanned layer no longer points to."""
+        files = self._credential_files if self.config["credentials-as-files"] else {}
+        for env_var in CREDENTIAL_OPTIONS:
+            path = self._credential_path(env_var)
+            if env_var not in files and container.exists(path):
+                container.remove_path(path)
+        if not files:
+            self._stored.files_hash = ""
+
+    @staticmethod
+    def _credential_path(env_var: str) -> str:
+        return f"{CREDENTIALS_DIR}/{env_var.lower()}"
+
     @property
     def app_environment(self):
         """Environment variables extracted from config."""
         env = {
             "APP_ID": self.config["app-id"],
-            "PRIVATE_KEY": self.config["private-key"],
-            "WEBHOOK_SECRET": self.config["webhook-secret"],
             "JIRA_INSTANCE": self.config["jira-instance"],
             "JIRA_USERNAME": self.config["jira-username"],
-            "JIRA_TOKEN": self.config["jira-token"],
         }
-        if bot_config := self.config["bot-config"]:
-            env["DEFAULT_BOT_CONFIG"] = bot_config
+        if self.config["credentials-as-files"]:
+            # Only the paths end up in the layer, so rotating a value does not restart the server.
+            for env_var in self._credential_files:
+                env[f"{env_var}_FILE"] = self._credential_path(env_var)
+        else:
+            env.update(self._credential_files)
         if bot_name := self.config["bot-name"]:
             env["BOT_NAME"] = bot_name
         # Proxy settings, if applicable.
@@ -101,43 +752,723 @@ class GitHubJiraBotCharm(ops.CharmBase):
             if redis_port and redis_host:
                 env["REDIS_HOST"] = redis_host
                 env["REDIS_PORT"] = redis_port
+                env.update(self._redis_features_environment)
+
+        self._check_redis_options(redis="REDIS_HOST" in env)
+
+        if self.config["ingestion-mode"] == "queue":
+            env["INGESTION_MODE"] = "queue"
+            env["DELIVERY_STREAM"] = f"{self.app.name}:deliveries"
+            env["DELIVERY_CONSUMER_GROUP"] = self._consumer_group
+            if max_length := self.config["queue-max-length"]:
+                env["DELIVERY_STREAM_MAXLEN"] = str(max_length)
+        if lanes := self._priority_lanes:
+            env["PRIORITY_LANES"] = json.dumps(lanes, sort_keys=True)
+        env.update(self._load_shedding_environment)
+        env.update(self._fair_scheduling_environment)
+        env.update(self._cache_environment)
         return env
 
     @property
-    def _pebble_layer(self):
-        command = " ".join(
-            [
-                "uvicorn",
-                "github_jira_sync_app.main:app",
-                "--host=0.0.0.0",
-                f"--port={self.config['port']}",
-            ]
+    def _cache_environment(self) -> Dict[str, str]:
+        """Settings of the workload caches that also work without Redis, in-process."""
+        max_age = self.config["sync-config-max-age"]
+        if max_age < 0:
+            raise InvalidConfigError("sync-config-max-age must not be negative")
+        env = {}
+        if max_age:
+            # Past max-age, the cached .jira_sync_config.yaml is revalidated with If-None-Match.
+            env["SYNC_CONFIG_MAX_AGE"] = str(max_age)
+        return env
+
+    @property
+    def _fair_scheduling_environment(self) -> Dict[str, str]:
+        """Weighted fair queuing of the delivery stream across repositories or installations."""
+        key = self.config["fair-scheduling"]
+        if key not in FAIR_SCHEDULING_KEYS:
+            raise InvalidConfigError(f"invalid fair-scheduling value: {key!r}")
+        if key == "off":
+            return {}
+        if self.config["ingestion-mode"] != "queue":
+            raise InvalidConfigError("fair-scheduling requires ingestion-mode=queue")
+
+        weights = self._repository_weights(key)
+        return {"FAIR_SCHEDULING": key, "REPOSITORY_WEIGHTS": json.dumps(weights, sort_keys=True)}
+
+    def _repository_weights(self, key: str) -> Dict[str, Dict[str, int]]:
+        """Validate `repository-weights`, keyed by "owner/repo" names or installation IDs.
+
+        Installation IDs are integers in YAML; they are turned into strings like the
+        repository names, as JSON object keys are.
+        """
+        try:
+            weights = yaml.safe_load(self.config["repository-weights"]) or {}
+        except yaml.YAMLError:
+            raise InvalidConfigError("repository-weights is not valid YAML")
+        if not isinstance(weights, dict):
+            raise InvalidConfigError("repository-weights must map names to settings")
+        for name, settings in weights.items():
+            if key == "installation" and (not isinstance(name, int) or isinstance(name, bool)):
+                raise InvalidConfigError(
+                    f"{name!r} is not an installation ID, as fair-scheduling=installation expects"
+                )
+            if key == "repository" and not (
+                isinstance(name, str) and REPOSITORY_PATTERN.fullmatch(name)
+            ):
+                raise InvalidConfigError(
+                    f"{name!r} is not an owner/repo name, as fair-scheduling=repository expects"
+                )
+            if (
+                not isinstance(settings, dict)
+                or not set(settings) <= {"weight", "max-concurrency"}
+                or not all(
+                    isinstance(v, int) and not isinstance(v, bool) and v > 0
+                    for v in settings.values()
+                )
+            ):
+                raise InvalidConfigError(
+                    f"{name!r} takes a positive weight and max-concurrency in repository-weights"
+                )
+        return {str(name): settings for name, settings in weights.items()}
+
+    @property
+    def _load_shedding_environment(self) -> Dict[str, str]:
+        """Admission control thresholds past which the webhook endpoint answers 503."""
+        max_inflight = self.config["shed-max-inflight"]
+        max_queue_depth = self.config["shed-max-queue-depth"]
+        retry_after = self.config["shed-retry-after"]
+        if max_inflight < 0 or max_queue_depth < 0 or retry_after < 1:
+            raise InvalidConfigError(
+                "shed thresholds must not be negative and shed-retry-after must be positive"
+            )
+        if max_queue_depth and self.config["ingestion-mode"] != "queue":
+            raise InvalidConfigError("shed-max-queue-depth requires ingestion-mode=queue")
+        max_length = self.config["queue-max-length"]
+        if max_length and not 0 < max_queue_depth < max_length:
+            # Trimming the stream drops unprocessed deliveries: shed them with 503 first.
+            raise InvalidConfigError("queue-max-length requires a lower shed-max-queue-depth")
+
+        env = {}
+        if max_inflight:
+            env["SHED_MAX_INFLIGHT"] = str(max_inflight)
+        if max_queue_depth:
+            env["SHED_MAX_QUEUE_DEPTH"] = str(max_queue_depth)
+        if env:
+            env["SHED_RETRY_AFTER"] = str(retry_after)
+        return env
+
+    @property
+    def _consumer_group(self) -> str:
+        return f"{self.app.name}-workers"
+
+    @property
+    def _priority_lanes(self) -> Dict[str, Dict]:
+        """Validated `priority-lanes` option: lane name to concurrency share and events.
+
+        Events are given as "event" or "event.action", e.g. "issues.opened". Events
+        matching no lane go to the "default" lane, which takes no events and whose share
+        can be set, otherwise it is always sent with the share of 1. Lanes are scheduled
+        by the worker service, so they require the `queue` ingestion mode.
+        """
+        if not self.config["priority-lanes"]:
+            return {}
+        try:
+            lanes = yaml.safe_load(self.config["priority-lanes"])
+        except yaml.YAMLError:
+            raise InvalidConfigError("priority-lanes is not valid YAML")
+        if not isinstance(lanes, dict) or not all(isinstance(name, str) for name in lanes):
+            raise InvalidConfigError("priority-lanes must map lane names to lanes")
+        if self.config["ingestion-mode"] != "queue":
+            # Shares split the worker service's queue-concurrency between the lanes.
+            raise InvalidConfigError("priority-lanes requires ingestion-mode=queue")
+
+        mapped: Set[str] = set()
+        for name, lane in lanes.items():
+            self._check_lane(name, lane)
+            if duplicates := mapped.intersection(lane["events"]):
+                raise InvalidConfigError(
+                    f"events in several lanes: {', '.join(sorted(duplicates))}"
+                )
+            mapped.update(lane["events"])
+        lanes.setdefault(DEFAULT_LANE, {"share": DEFAULT_LANE_SHARE, "events": []})
+        return lanes
+
+    @staticmethod
+    def _check_lane(name: str, lane):
+        if not isinstance(lane, dict) or set(lane) != {"share", "events"}:
+            raise InvalidConfigError(f"lane {name!r} must define a share and events")
+        if type(lane["share"]) is not int or lane["share"] < 1:
+            raise InvalidConfigError(f"share of lane {name!r} must be a positive integer")
+        if name == DEFAULT_LANE and lane["events"] != []:
+            raise InvalidConfigError(f"lane {name!r} takes the events of no other lane")
+        if not isinstance(lane["events"], list) or not all(
+            isinstance(event, str) and EVENT_PATTERN.fullmatch(event) for event in lane["events"]
+        ):
+            raise InvalidConfigError(f"events of lane {name!r} must be a list of event[.action]")
+
+    def _check_redis_options(self, redis: bool):
+        for option in REDIS_OPTIONS:
+            if self.config[option] < 0:
+                raise InvalidConfigError(f"{option} must not be negative")
+        if self.config["local-cache-max-mb"] < 1:
+            raise InvalidConfigError("local-cache-max-mb must be a positive integer")
+        if self.config["token-cache-margin"] >= INSTALLATION_TOKEN_LIFETIME:
+            raise InvalidConfigError("token-cache-margin must be below 3600")
+        # Parsing validates the option, so it is checked even without Redis.
+        self._parse_jira_metadata_ttl()
+        for option in REDIS_OPTIONS:
+            if self.config[option] and not redis:
+                raise InvalidConfigError(f"{option} requires a redis relation")
+
+    @property
+    def _redis_features_environment(self) -> Dict[str, str]:
+        """Settings of the workload features keeping their state in Redis, shared by all units."""
+        env = {"REDIS_KEY_PREFIX": f"{self.app.name}:"}
+        if self.config["ownership-vnodes"]:
+            # The ring changes with the units, so it is a file rather than part of the layer.
+            env["HASH_RING_FILE"] = HASH_RING_FILE
+            env["HANDOFF_QUEUE_PREFIX"] = f"{self.app.name}:handoff:"
+        if dedup_ttl := self.config["dedup-ttl"]:
+            env["DELIVERY_DEDUP_TTL"] = str(dedup_ttl)
+        if token_cache_margin := self.config["token-cache-margin"]:
+            # Tokens are cached per installation ID, with a single-flight refresh lock.
+            env["INSTALLATION_TOKEN_CACHE_TTL"] = str(
+                INSTALLATION_TOKEN_LIFETIME - token_cache_margin
+            )
+        if debounce_window := self.config["debounce-window"]:
+            env["DEBOUNCE_WINDOW"] = str(debounce_window)
+        if self.config["issue-key-index"]:
+            self._require_image_module(ISSUE_INDEX_MODULE)
+            # Hash of "<owner>/<repo>#<number>" to the key of the linked Jira issue.
+            env["ISSUE_KEY_INDEX_KEY"] = f"{self.app.name}:issue-keys"
+        if jira_metadata_ttl := self._parse_jira_metadata_ttl():
+            # Entries are keyed JIRA_METADATA_KEY_PREFIX + "<category>:<...>".
+            env["JIRA_METADATA_KEY_PREFIX"] = f"{self.app.name}:jira-metadata:"
+            env["JIRA_METADATA_TTL"] = json.dumps(jira_metadata_ttl, sort_keys=True)
+        if local_cache_entries := self.config["local-cache-max-entries"]:
+            # In-process LRU of each worker in front of the Redis caches above; writers
+            # publish the invalidated keys or key patterns on the channel.
+            env["LOCAL_CACHE_MAX_ENTRIES"] = str(local_cache_entries)
+            env["LOCAL_CACHE_MAX_BYTES"] = str(self.config["local-cache-max-mb"] * 2**20)
+            env["CACHE_INVALIDATION_CHANNEL"] = f"{self.app.name}:cache-invalidation"
+        env.update(self._retry_environment)
+        env.update(self._rate_limit_environment)
+        return env
+
+    def _parse_jira_metadata_ttl(self) -> Dict[str, int]:
+        """Validate the `jira-metadata-ttl` option and return it without disabled categories."""
+        try:
+            ttls = yaml.safe_load(self.config["jira-metadata-ttl"]) or {}
+        except yaml.YAMLError:
+            raise InvalidConfigError("jira-metadata-ttl is not valid YAML")
+        if not isinstance(ttls, dict) or not set(ttls) <= set(JIRA_METADATA_CATEGORIES):
+            raise InvalidConfigError(
+                f"jira-metadata-ttl keys must be among {', '.join(JIRA_METADATA_CATEGORIES)}"
+            )
+        if not all(type(ttl) is int and ttl >= 0 for ttl in ttls.values()):
+            raise InvalidConfigError("jira-metadata-ttl values must be non-negative integers")
+        return {category: ttl for category, ttl in ttls.items() if ttl}
+
+    @property
+    def _retry_environment(self) -> Dict[str, str]:
+        env = {}
+        if retry_max_attempts := self.config["retry-max-attempts"]:
+            base_delay = self.config["retry-base-delay"]
+            if base_delay < 1 or self.config["retry-max-delay"] < base_delay:
+                raise InvalidConfigError(
+                    "retry-base-delay must be positive and at most retry-max-delay"
+                )
+            if self.config["retry-drain-rate"] < 1 or self.config["dead-letter-max-length"] < 1:
+                raise InvalidConfigError(
+                    "retry-drain-rate and dead-letter-max-length must be positive integers"
+                )
+            # Dead letters are RPUSHed, oldest first, as the unique JSON members of the
+            # schedule they fell off; see redis_admin.py, which moves them back.
+            env.update(
+                {
+                    "RETRY_MAX_ATTEMPTS": str(retry_max_attempts),
+                    "RETRY_BASE_DELAY": str(base_delay),
+                    "RETRY_MAX_DELAY": str(self.config["retry-max-delay"]),
+                    "RETRY_DRAIN_RATE": str(self.config["retry-drain-rate"]),
+                    "RETRY_SCHEDULE_KEY": f"{self.app.name}:retries",
+                    "DEAD_LETTER_KEY": f"{self.app.name}:dead-letters",
+                    "DEAD_LETTER_MAXLEN": str(self.config["dead-letter-max-length"]),
+                }
+            )
+        return env
+
+    @property
+    def _rate_limit_environment(self) -> Dict[str, str]:
+        env = {}
+        for upstream in ("github", "jira"):
+            if rate_limit := self.config[f"{upstream}-rate-limit"]:
+                burst = self.config[f"{upstream}-rate-burst"]
+                if burst < 0:
+                    raise InvalidConfigError(f"{upstream}-rate-burst must not be negative")
+                env[f"{upstream.upper()}_RATE_LIMIT"] = str(rate_limit)
+                # The bucket holds a minute of tokens unless told otherwise.
+                env[f"{upstream.upper()}_RATE_BURST"] = str(burst or rate_limit)
+        return env
+
+    def _redis_admin(self, *args: str) -> Dict:
+        """Run a redis_admin.py command in the workload and return its JSON output."""
+        env = self._action_environment
+        if "REDIS_HOST" not in env:
+            raise WorkloadCommandError("This requires a redis relation")
+        container = self._action_container
+        container.push(REDIS_ADMIN, REDIS_ADMIN_SOURCE.read_text(), make_dirs=True)
+        return self._exec_json(
+            container,
+            ["python3", REDIS_ADMIN, *args],
+            {key: env[key] for key in REDIS_ADMIN_ENVIRONMENT},
+        )
+
+    @property
+    def _action_environment(self) -> Dict[str, str]:
+        try:
+            return self.app_environment
+        except InvalidConfigError as e:
+            raise WorkloadCommandError(str(e))
+
+    @property
+    def _action_container(self) -> ops.Container:
+        container = self.unit.get_container(WORKLOAD_CONTAINER)
+        if not container.can_connect():
+            raise WorkloadCommandError("Unable to connect to the Pebble API")
+        return container
+
+    @staticmethod
+    def _exec_json(container: ops.Container, command: List[str], environment: Dict[str, str]):
+        """Run `command` in the workload container and parse its JSON output."""
+        try:
+            stdout, _ = container.exec(command, environment=environment).wait_output()
+        except (ops.pebble.ExecError, ops.pebble.APIError) as e:
+            raise WorkloadCommandError(f"{' '.join(command[:3])} failed: {e}")
+        try:
+            return json.loads(stdout)
+        except ValueError:
+            raise WorkloadCommandError(f"{' '.join(command[:3])} returned invalid JSON")
+
+    def _run_redis_admin(self, event: ops.ActionEvent, *args: str):
+        """Run a redis_admin.py command for an action and report its output as results."""
+        try:
+            output = self._redis_admin(*args)
+        except WorkloadCommandError as e:
+            event.fail(str(e))
+            return
+        event.set_results(
+            {
+                key: json.dumps(value) if isinstance(value, list) else value
+                for key, value in output.items()
+            }
+        )
+
+    def _on_dead_letters_list(self, event: ops.ActionEvent):
+        if event.params["limit"] < 1:
+            # LRANGE 0 -1 would return the whole list.
+            event.fail("limit must be a positive integer")
+            return
+        self._run_redis_admin(event, "dead-letters-list", f"--limit={event.params['limit']}")
+
+    def _on_dead_letters_requeue(self, event: ops.ActionEvent):
+        if event.params["count"] < 0:
+            event.fail("count must not be negative")
+            return
+        self._run_redis_admin(event, "dead-letters-requeue", f"--count={event.params['count']}")
+
+    def _on_dead_letters_purge(self, event: ops.ActionEvent):
+        self._run_redis_admin(event, "dead-letters-purge")
+
+    def _on_rebuild_issue_index(self, event: ops.ActionEvent):
+        """Rebuild the issue-to-Jira-key index from one paginated JQL scan, in the workload."""
+        try:
+            env = self._action_environment
+            if "ISSUE_KEY_INDEX_KEY" not in env:
+                raise WorkloadCommandError("This requires a redis relation and issue-key-index")
+            container = self._action_container
+            try:
+                self._require_image_module(ISSUE_INDEX_MODULE)
+            except InvalidConfigError as e:
+                raise WorkloadCommandError(str(e))
+            event.log("Scanning Jira issues, this can take a while")
+            output = self._exec_json(
+                container, ["python3", "-m", ISSUE_INDEX_MODULE, "rebuild"], env
+            )
+        except WorkloadCommandError as e:
+            event.fail(str(e))
+            return
+        event.set_results(output)
+
+    def _on_invalidate_jira_cache(self, event: ops.ActionEvent):
+        category = event.params["category"]
+        if category and category not in JIRA_METADATA_CATEGORIES:
+            event.fail(f"category must be one of {', '.join(JIRA_METADATA_CATEGORIES)}")
+            return
+        self._run_redis_admin(event, "jira-cache-invalidate", f"--category={category}")
+
+    @property
+    def _workers(self) -> int:
+        """Number of worker processes requested by the `workers` option."""
+        workers = str(self.config["workers"]).strip().lower()
+        if workers == "auto":
+            return self._cpu_quota_workers()
+        try:
+            count = int(workers)
+        except ValueError:
+            raise InvalidConfigError(f"invalid workers value: {workers!r}")
+        if count < 1:
+            raise InvalidConfigError("workers must be a positive integer or 'auto'")
+        return count
+
+    def _cpu_quota_workers(self) -> int:
+        """Derive a worker count from the workload container's cgroup CPU quota.
+
+        Falls back to AUTO_WORKERS_FALLBACK when no quota is set: the CPUs visible to the
+        charm are the node's. The quota is read once per hook, as long as `cpu-limit` does
+        not change.
+        """
+        cpu_limit = self.config["cpu-limit"]
+        if self._auto_workers is None or self._auto_workers[0] != cpu_limit:
+            quota = self._cpu_quota()
+            if quota is None:
+                logger.warning(
+                    "No CPU quota on the workload container, using %d workers",
+                    AUTO_WORKERS_FALLBACK,
+                )
+                workers = AUTO_WORKERS_FALLBACK
+            else:
+                workers = max(1, math.ceil(quota))
+            self._auto_workers = (cpu_limit, workers, quota is None)
+        return self._auto_workers[1]
+
+    def _cpu_quota(self):
+        """CPU quota of the workload container in cores, or None if unlimited."""
+        # The configured limit applies as soon as the pod is rescheduled with it.
+        if cpu_limit := self._resource_requirements["limits"].get("cpu"):
+            return float(parse_quantity(cpu_limit))
+        container = self.unit.get_container("gh-jira-bot")
+        try:
+            # cgroup v2: "<quota> <period>", quota being "max" when unlimited.
+            quota, period = container.pull(CGROUP_V2_CPU_MAX).read().split()
+            if quota == "max":
+                return None
+            return int(quota) / int(period)
+        except (ops.pebble.PathError, ValueError):
+            pass
+        try:
+            # cgroup v1: quota is -1 when unlimited.
+            quota = int(container.pull(CGROUP_V1_CPU_QUOTA).read())
+            period = int(container.pull(CGROUP_V1_CPU_PERIOD).read())
+        except (ops.pebble.PathError, ValueError):
+            logger.warning("Unable to read the cgroup CPU quota of the workload container")
+            return None
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+
+    @property
+    def _server_command(self) -> str:
+        """Command line of the webhook server for the configured `server` mode."""
+        server = self.config["server"]
+        for option in ("backlog", "timeout-keep-alive"):
+            if self.config[option] < 1:
+                raise InvalidConfigError(f"{option} must be a positive integer")
+        if server == "uvicorn":
+            args = self._uvicorn_args
+        elif server == "gunicorn":
+            args = self._gunicorn_args
+        else:
+            raise InvalidConfigError(f"invalid server value: {server!r}")
+        return " ".join(args)
+
+    @property
+    def _uvicorn_args(self) -> List[str]:
+        loop = self.config["loop"]
+        http = self.config["http"]
+        if loop not in UVICORN_LOOPS:
+            raise InvalidConfigError(f"invalid loop value: {loop!r}")
+        if http not in UVICORN_HTTP_PARSERS:
+            raise InvalidConfigError(f"invalid http value: {http!r}")
+        for option in ("limit-concurrency", "limit-max-requests"):
+            if self.config[option] < 0:
+                raise InvalidConfigError(f"{option} must not be negative")
+        # "auto" picks uvloop/httptools when available, explicit values must be installed.
+        for module in (loop, http):
+            if module in ("uvloop", "httptools"):
+                self._require_image_module(module)
+
+        args = [
+            "uvicorn",
+            APP_MODULE,
+            "--host=0.0.0.0",
+            f"--port={self.config['port']}",
+            f"--workers={self._workers}",
+            f"--loop={loop}",
+            f"--http={http}",
+            f"--backlog={self.config['backlog']}",
+            f"--timeout-keep-alive={self.config['timeout-keep-alive']}",
+        ]
+        # 0 means unlimited, which is uvicorn's behaviour when the flag is absent.
+        if limit_concurrency := self.config["limit-concurrency"]:
+            args.append(f"--limit-concurrency={limit_concurrency}")
+        if limit_max_requests := self.config["limit-max-requests"]:
+            args.append(f"--limit-max-requests={limit_max_requests}")
+        return args
+
+    @property
+    def _gunicorn_args(self) -> List[str]:
+        # gunicorn's UvicornWorker does not take the loop, parser or concurrency
+        # limit from the command line, and recycles workers through max-requests.
+        for option in ("loop", "http"):
+            if self.config[option] != "auto":
+                raise InvalidConfigError(f"{option} is only supported with server=uvicorn")
+        for option in ("limit-concurrency", "limit-max-requests"):
+            if self.config[option]:
+                raise InvalidConfigError(f"{option} is only supported with server=uvicorn")
+        for option in ("max-requests", "max-requests-jitter"):
+            if self.config[option] < 0:
+                raise InvalidConfigError(f"{option} must not be negative")
+        for option in ("graceful-timeout", "worker-timeout"):
+            if self.config[option] < 1:
+                raise InvalidConfigError(f"{option} must be a positive integer")
+        self._require_image_module("gunicorn")
+
+        # The app is imported once in the master (--preload) and the
+        # workers are forked from it, sharing its memory copy-on-write.
+        return [
+            "gunicorn",
+            APP_MODULE,
+            "--worker-class=uvicorn.workers.UvicornWorker",
+            f"--bind=0.0.0.0:{self.config['port']}",
+            f"--workers={self._workers}",
+            "--preload",
+            f"--backlog={self.config['backlog']}",
+            f"--keep-alive={self.config['timeout-keep-alive']}",
+            f"--max-requests={self.config['max-requests']}",
+            f"--max-requests-jitter={self.config['max-requests-jitter']}",
+            f"--graceful-timeout={self.config['graceful-timeout']}",
+            f"--timeout={self.config['worker-timeout']}",
+            f"--config={GUNICORN_CONFIG}",
+        ]
+
+    @property
+    def _multiprocess_metrics(self) -> bool:
+        """Whether several processes serve the metrics and must share their samples."""
+        return (
+            self.config["server"] == "gunicorn"
+            or self._workers > 1
+            or bool(self.config["metrics-port"])
         )
 
+    @property
+    def _metrics_port(self) -> int:
+        """Port scraped by Prometheus: the dedicated metrics listener's, if any."""
+        return self.config["metrics-port"] or self.config["port"]
+
+    def _push_server_files(self, container: ops.Container):
+        """Push the helper files used by the Pebble services into the workload container."""
+        if self.config["server"] == "gunicorn":
+            container.push(GUNICORN_CONFIG, GUNICORN_CONFIG_SOURCE.read_text(), make_dirs=True)
+        if self.config["metrics-port"]:
+            container.push(METRICS_SERVER, METRICS_SERVER_SOURCE.read_text(), make_dirs=True)
+
+    @property
+    def _metrics_service(self):
+        """Pebble service exporting the aggregated worker samples on `metrics-port`.
+
+        It merges the samples of the webhook server workers with those of the worker
+        service, which has no HTTP listener of its own.
+        The service stays in the plan, disabled, when `metrics-port` is unset: layers cannot
+        remove services, and replanning stops a disabled service whose definition changed.
+        """
+        metrics_port = self.config["metrics-port"]
+        if metrics_port:
+            if not 0 < metrics_port < 65536 or metrics_port == self.config["port"]:
+                raise InvalidConfigError("metrics-port must be a valid port other than port")
+            self._require_image_module("prometheus_client")
+        elif self.config["ingestion-mode"] == "queue":
+            raise InvalidConfigError("ingestion-mode=queue requires metrics-port")
         return {
+            "override": "replace",
+            "summary": "gh-jira-bot metrics exporter",
+            "command": " ".join(
+                [
+                    "python3",
+                    METRICS_SERVER,
+                    str(metrics_port),
+                    METRICS_MULTIPROC_DIR,
+                    WORKER_METRICS_MULTIPROC_DIR,
+                ]
+            ),
+            "startup": "enabled" if metrics_port else "disabled",
+            "after": [SERVICE_NAME],
+        }
+
+    def _require_image_module(self, module: str):
+        """Raise InvalidConfigError if `module` cannot be imported in the OCI image."""
+        container = self.unit.get_container("gh-jira-bot")
+        try:
+            container.exec(["python3", "-c", f"import {module}"]).wait()
+        except (ops.pebble.ExecError, ops.pebble.APIError):
+            raise InvalidConfigError(f"{module} is not available in the OCI image")
+
+    @property
+    def _pebble_layer(self):
+        command = self._server_command
+        environment = self.app_environment
+        if self._multiprocess_metrics:
+            # Every worker writes its samples under the directory and /metrics aggregates
+            # them. It is emptied on each (re)start so that counters restart from zero.
+            environment["PROMETHEUS_MULTIPROC_DIR"] = METRICS_MULTIPROC_DIR
+            command = self._multiprocess_command(command, METRICS_MULTIPROC_DIR)
+
+        layer = {
             "summary": "gh-jira-bot layer",
             "services": {
-                "gh-jira-bot-service": {
+                SERVICE_NAME: {
                     "override": "replace",
                     "summary": "httpbin",
                     "command": command,
                     "startup": "enabled",
-                    "environment": self.app_environment,
+                    "environment": environment,
+                    "on-check-failure": {LIVENESS_CHECK: "restart"},
                 }
             },
+            "checks": self._health_checks,
         }
+        layer["services"][METRICS_SERVICE_NAME] = self._metrics_service
+        layer["services"][WORKER_SERVICE_NAME] = self._worker_service(environment)
+        return layer
 
-    def _handle_ports(self):
-        port = int(self.config["port"])
-        opened_ports = self.unit.opened_ports()
+    @staticmethod
+    def _multiprocess_command(command: str, path: str) -> str:
+        """Wrap `command` to start it with an empty multiprocess metrics directory."""
+        return " ".join(
+            [
+                "/bin/sh",
+                "-c",
+                shlex.quote(f"rm -rf {path} && mkdir -p {path} && exec {command}"),
+            ]
+        )
+
+    def _worker_service(self, environment: Dict[str, str]):
+        """Pebble service consuming the delivery stream in `queue` ingestion mode.
+
+        In this mode the webhook server only verifies the signature, appends the delivery
+        to the Redis stream and answers 202; this service does the GitHub and Jira work.
+        Like the metrics service, it stays in the plan, disabled, in `sync` mode. Its samples
+        go to a directory of their own, exported by the metrics service, so that restarting
+        the webhook server does not wipe them.
+        """
+        mode = self.config["ingestion-mode"]
+        concurrency = self.config["queue-concurrency"]
+        if mode not in INGESTION_MODES:
+            raise InvalidConfigError(f"invalid ingestion-mode value: {mode!r}")
+        if mode == "queue":
+            if "REDIS_HOST" not in environment:
+                raise InvalidConfigError("ingestion-mode=queue requires a redis relation")
+            if concurrency < 1 or self.config["queue-max-length"] < 0:
+                raise InvalidConfigError(
+                    "queue-concurrency must be positive and queue-max-length must not be negative"
+                )
+            self._require_image_module(WORKER_MODULE)
+        return {
+            "override": "replace",
+            "summary": "gh-jira-bot delivery stream consumer",
+            "command": self._multiprocess_command(
+                " ".join(
+                    [
+                        "python3",
+                        "-m",
+                        WORKER_MODULE,
+                        f"--concurrency={concurrency}",
+                        # Each unit reads the stream as its own consumer of the shared group.
+                        f"--consumer={self.unit.name.replace('/', '-')}",
+                    ]
+                ),
+                WORKER_METRICS_MULTIPROC_DIR,
+            ),
+            "startup": "enabled" if mode == "queue" else "disabled",
+            "environment": {
+                **environment,
+                "PROMETHEUS_MULTIPROC_DIR": WORKER_METRICS_MULTIPROC_DIR,
+            },
+        }
 
-        if port in [i.port for i in opened_ports]:
+    @property
+    def _health_checks(self):
+        """Pebble checks probing the webhook server.
+
+        Juju maps the "ready" and "alive" levels onto the Kubernetes readiness and liveness
+        probes of the workload container, so a failing readiness check takes the unit out
+        of the service endpoints while a failing liveness check restarts the service. The
+        liveness check runs less often, so that a slow period takes the unit out of
+        rotation well before it gets restarted.
+        """
+        period = self.config["check-period"]
+        timeout = self.config["check-timeout"]
+        threshold = self.config["check-threshold"]
+        if period < 1 or threshold < 1:
+            raise InvalidConfigError("check-period and check-threshold must be positive integers")
+        if not 1 <= timeout < period:
+            raise InvalidConfigError("check-timeout must be at least 1 and below check-period")
+
+        check = {
+            "override": "replace",
+            "timeout": f"{timeout}s",
+            "threshold": threshold,
+            **self._health_probe,
+        }
+        return {
+            READINESS_CHECK: {**check, "level": "ready", "period": f"{period}s"},
+            LIVENESS_CHECK: {
+                **check,
+                "level": "alive",
+                "period": f"{period * LIVENESS_PERIOD_FACTOR}s",
+            },
+        }
+
+    @property
+    def _health_probe(self) -> Dict[str, Dict]:
+        """HTTP probe of `health-check-path`, or a TCP connection to the port if unset."""
+        path = self.config["health-check-path"]
+        if not path:
+            return {"tcp": {"port": self.config["port"]}}
+        if not path.startswith("/"):
+            raise InvalidConfigError("health-check-path must start with '/'")
+        return {"http": {"url": f"http://localhost:{self.config['port']}{path}"}}
+
+    def _update_health_status(self):
+        """Report failing Pebble checks in the unit status."""
+        relation = self.model.get_relation(PEER_RELATION)
+        if relation is not None and relation.data[self.unit].get("restart"):
+            # The restart lock owns the status until the restart completes.
+            return
+        if isinstance(self.unit.status, (ops.BlockedStatus, ops.WaitingStatus)):
             return
+        container = self.unit.get_container("gh-jira-bot")
+        if not container.can_connect():
+            return
+        failing = [
+            f"{check.name} ({check.failures}/{check.threshold})"
+            for check in container.get_checks(READINESS_CHECK, LIVENESS_CHECK).values()
+            if check.status != ops.pebble.CheckStatus.UP
+        ]
+        if failing:
+            self.unit.status = ops.MaintenanceStatus(f"failing checks: {', '.join(failing)}")
+        else:
+            self.unit.status = self._active_status(self._workers)
+
+    def _handle_ports(self):
+        ports = {int(self.config["port"]), int(self._metrics_port)}
+        opened_ports = self.unit.opened_ports()
 
         for o_port in opened_ports:
-            self.unit.close_port(o_port.protocol, o_port.port)
+            if o_port.port not in ports:
+                self.unit.close_port(o_port.protocol, o_port.port)
 
-        self.unit.open_port("tcp", port)
+        for port in ports - {i.port for i in opened_ports}:
+            self.unit.open_port("tcp", port)
 
 
 if __name__ == "__main__":  # pragma: nocover
@@ -0,0 +1,15 @@
+"""Gunicorn configuration of the webhook server, pushed into the workload container.
+
+The charm runs gunicorn with --config pointing at this file. The prometheus_client
+package is optional in the OCI image: without it, there are no metrics to clean up.
+"""
+try:
+    from prometheus_client import multiprocess
+except ImportError:
+    multiprocess = None
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of workers recycled by max-requests or timeouts."""
+    if multiprocess is not None:
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Prometheus exporter of the multiprocess metrics of the workload services.
+
+The charm pushes this script into the workload container, whose image ships the
+`prometheus_client` package, and runs it as a Pebble service with the port to listen on
+followed by the multiprocess directories of the webhook server and the worker service.
+"""
+import glob
+import os
+import sys
+import time
+
+from prometheus_client import CollectorRegistry, start_http_server
+from prometheus_client.multiprocess import MultiProcessCollector
+
+
+class Collector:
+    """Merge the samples of every directory given on the command line."""
+
+    def collect(self):
+        """Return the metrics merged from the samples files of all directories."""
+        files = [f for path in sys.argv[2:] for f in glob.glob(os.path.join(path, "*.db"))]
+        return MultiProcessCollector.merge(files, accumulate=True)
+
+
+def main():
+    """Serve the merged metrics until the service is stopped."""
+    registry = CollectorRegistry()
+    registry.register(Collector())
+    start_http_server(int(sys.argv[1]), registry=registry)
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Maintenance commands run by the charm actions against the workload's Redis keys.
+
+The charm pushes this script into the workload container, whose image ships the `redis`
+package used by the app, and runs it with REDIS_HOST, REDIS_PORT and REDIS_KEY_PREFIX set.
+Results are printed as JSON on stdout.
+
+The workload appends each dead letter with RPUSH to the REDIS_KEY_PREFIX + "dead-letters"
+list and trims it from the left, so the list runs from the oldest entry to the newest.
+Entries are the JSON members of the REDIS_KEY_PREFIX + "retries" sorted set they fell off,
+scored by their next attempt time, and carry the delivery ID and attempt count so that
+two failures never share a member.
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import time
+
+import redis
+
+# Entries moved from the dead-letter list to the retry schedule by each script run.
+REQUEUE_BATCH = 1000
+REQUEUE_SCRIPT = """
+local entries = redis.call("LRANGE", KEYS[1], 0, tonumber(ARGV[1]) - 1)
+local added = 0
+for _, entry in ipairs(entries) do
+    added = added + redis.call("ZADD", KEYS[2], ARGV[2], entry)
+end
+redis.call("LTRIM", KEYS[1], #entries, -1)
+return {#entries, added}
+"""
+# Most entries counted one by one when estimating the backlog of the delivery stream.
+STREAM_STATS_MAX_COUNT = 10000
+
+
+def _key(name: str) -> str:
+    return os.environ["REDIS_KEY_PREFIX"] + name
+
+
+def dead_letters_list(client: redis.Redis, args: argparse.Namespace) -> dict:
+    """Show the oldest entries of the dead-letter list."""
+    entries = client.lrange(_key("dead-letters"), 0, args.limit - 1)
+    return {
+        "count": client.llen(_key("dead-letters")),
+        "entries": [entry.decode(errors="replace") for entry in entries],
+    }
+
+
+def dead_letters_requeue(client: redis.Redis, args: argparse.Namespace) -> dict:
+    """Move dead letters back to the retry schedule, due now, oldest first.
+
+    Batches are moved by a Lua script, so an entry is never in both keys or in neither.
+    Entries equal to a retry already scheduled are merged with it by the sorted set and
+    reported as such.
+    """
+    move = client.register_script(REQUEUE_SCRIPT)
+    requeued = merged = 0
+    while not args.count or requeued < args.count:
+        batch = REQUEUE_BATCH if not args.count else min(REQUEUE_BATCH, args.count - requeued)
+        moved, added = move(
+            keys=[_key("dead-letters"), _key("retries")], args=[batch, time.time()]
+        )
+        requeued += moved
+        merged += moved - added
+        if moved < batch:
+            break
+    return {"requeued": requeued, "merged": merged}
+
+
+def dead_letters_purge(client: redis.Redis, _: argparse.Namespace) -> dict:
+    """Drop every entry of the dead-letter list."""
+    pipeline = client.pipeline()
+    pipeline.llen(_key("dead-letters"))
+    pipeline.delete(_key("dead-letters"))
+    purged, _ = pipeline.execute()
+    return {"purged": purged}
+
+
+def jira_cache_invalidate(client: redis.Redis, args: argparse.Namespace) -> dict:
+    """Delete the cached Jira metadata of one category, or of all of them."""
+    pattern = _key(f"jira-metadata:{args.category or '*'}:*")
+    deleted = 0
+    batch = []
+    for key in client.scan_iter(match=pattern, count=1000):
+        batch.append(key)
+        if len(batch) == 1000:
+            deleted += client.delete(*batch)
+            batch = []
+    if batch:
+        deleted += client.delete(*batch)
+    # Drop the entries from the in-process caches of every worker as well.
+    client.publish(_key("cache-invalidation"), json.dumps({"pattern": pattern}))
+    return {"deleted": deleted}
+
+
+def _undelivered(client: redis.Redis, stream: str, group: dict, last_delivered: str) -> int:
+    """Entries not yet delivered to the group, when Redis does not report its lag."""
+    # Redis 7 counts the entries added to the stream and read by each group, but leaves
+    # the lag unset after deletions in the unread range.
+    entries_added = client.xinfo_stream(stream).get("entries-added")
+    entries_read = group.get("entries-read")
+    if entries_added is not None and entries_read is not None:
+        return max(0, entries_added - entries_read)
+    # Otherwise count, up to a bound: past it, the backlog is large anyway.
+    return len(
+        client.xrange(stream, min=f"({last_delivered}", max="+", count=STREAM_STATS_MAX_COUNT)
+    )
+
+
+def stream_stats(client: redis.Redis, args: argparse.Namespace) -> dict:
+    """Backlog of the delivery stream consumer group and age of its oldest entry."""
+    stream = _key("deliveries")
+    if not client.exists(stream):
+        return {"backlog": 0, "oldest-age": 0}
+    groups = {group["name"].decode(): group for group in client.xinfo_groups(stream)}
+    group = groups.get(args.group)
+    if group is None:
+        # No consumer has started yet: the whole stream is waiting.
+        backlog = client.xlen(stream)
+        oldest = client.xrange(stream, count=1)
+    else:
+        pending = client.xpending(stream, args.group)
+        last_delivered = group["last-delivered-id"].decode()
+        undelivered = group.get("lag")
+        if undelivered is None:
+            undelivered = _undelivered(client, stream, group, last_delivered)
+        backlog = pending["pending"] + undelivered
+        oldest_id = pending["min"] if pending["pending"] else None
+        oldest = (
+            [(oldest_id, None)]
+            if oldest_id
+            else client.xrange(stream, min=f"({last_delivered}", max="+", count=1)
+        )
+    oldest_age = 0.0
+    if backlog and oldest:
+        entry_id = oldest[0][0]
+        entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+        oldest_age = max(0.0, time.time() - int(entry_id.split("-")[0]) / 1000)
+    return {"backlog": backlog, "oldest-age": round(oldest_age, 3)}
+
+
+def _ring_hash(key: str) -> int:
+    # Same as ring_hash() in the charm: the first 64 bits of the SHA-256 of the key.
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+def handoff_reassign(client: redis.Redis, args: argparse.Namespace) -> dict:
+    """Move the events queued for departed units to the queue of their repository's owner.
+
+    Every handoff queue of a unit missing from the comma-separated members is emptied.
+    Entries are JSON objects whose "repository" is the "owner/name" of the event. The
+    owner is looked up in the hash ring file; entries without a repository, or whose
+    owner is not a member, go to the fallback unit. Each entry is moved atomically.
+    """
+    with open(args.ring) as ring_file:
+        points = json.load(ring_file)["points"]
+    hashes = [position for position, _ in points]
+    members = set(args.members.split(","))
+    prefix = _key("handoff:")
+    reassigned = {}
+    for queue in client.scan_iter(match=f"{prefix}*"):
+        unit = queue.decode()[len(prefix) :]
+        if unit in members:
+            continue
+        reassigned[unit] = 0
+        while (entry := client.lindex(queue, 0)) is not None:
+            try:
+                repository = json.loads(entry).get("repository")
+            except (ValueError, AttributeError):
+                repository = None
+            owner = args.fallback
+            if points and isinstance(repository, str):
+                position = bisect.bisect_left(hashes, _ring_hash(repository)) % len(points)
+                if points[position][1] in members:
+                    owner = points[position][1]
+            client.lmove(queue, prefix + owner, "LEFT", "RIGHT")
+            reassigned[unit] += 1
+    return {"reassigned": reassigned}
+
+
+def main():
+    """Parse the command line and print the result of the requested command."""
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("dead-letters-list")
+    list_parser.add_argument("--limit", type=int, default=20)
+    list_parser.set_defaults(func=dead_letters_list)
+    requeue_parser = commands.add_parser("dead-letters-requeue")
+    requeue_parser.add_argument("--count", type=int, default=0)
+    requeue_parser.set_defaults(func=dead_letters_requeue)
+    purge_parser = commands.add_parser("dead-letters-purge")
+    purge_parser.set_defaults(func=dead_letters_purge)
+    invalidate_parser = commands.add_parser("jira-cache-invalidate")
+    invalidate_parser.add_argument("--category", default="")
+    invalidate_parser.set_defaults(func=jira_cache_invalidate)
+    stats_parser = commands.add_parser("stream-stats")
+    stats_parser.add_argument("--group", required=True)
+    stats_parser.set_defaults(func=stream_stats)
+    reassign_parser = commands.add_parser("handoff-reassign")
+    reassign_parser.add_argument("--members", required=True)
+    reassign_parser.add_argument("--ring", required=True)
+    reassign_parser.add_argument("--fallback", required=True)
+    reassign_parser.set_defaults(func=handoff_reassign)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=os.environ["REDIS_HOST"], port=int(os.environ["REDIS_PORT"]))
+    print(json.dumps(args.func(client, args)))
+
+
+if __name__ == "__main__":
+    main()
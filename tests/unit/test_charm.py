@@ -0,0 +1,654 @@
+import json
+
+import ops
+import ops.testing
+import pytest
+from lightkube import ConfigError
+from lightkube.models.apps_v1 import StatefulSetSpec
+from lightkube.models.core_v1 import (
+    Container,
+    PodSpec,
+    PodTemplateSpec,
+    ResourceRequirements,
+)
+from lightkube.models.meta_v1 import LabelSelector
+from lightkube.resources.apps_v1 import StatefulSet
+from lightkube.resources.core_v1 import Pod
+
+import charm
+from charm import GitHubJiraBotCharm
+
+CONFIG = {
+    key: key
+    for key in [
+        "app-id",
+        "jira-instance",
+        "jira-username",
+        "jira-token",
+        "private-key",
+        "webhook-secret",
+    ]
+}
+CONTAINER = "gh-jira-bot"
+PEER = "charmed-github-jira-bot/1"
+
+
+@pytest.fixture
+def harness():
+    harness = ops.testing.Harness(GitHubJiraBotCharm)
+    harness.set_model_name("testing")
+    harness.update_config(CONFIG)
+    # Probes of the modules available in the OCI image.
+    harness.handle_exec(CONTAINER, ["python3"], result=0)
+    harness.begin_with_initial_hooks()
+    harness.container_pebble_ready(CONTAINER)
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    class Clock:
+        now = 1000.0
+
+        def time(self):
+            return self.now
+
+        monotonic = time
+
+        def sleep(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(charm, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def queue_harness(harness):
+    relation_id = harness.add_relation("redis", "redis-k8s")
+    harness.add_relation_unit(relation_id, "redis-k8s/0")
+    harness.update_relation_data(relation_id, "redis-k8s/0", {"hostname": "redis", "port": "6379"})
+    harness.update_config({"ingestion-mode": "queue", "metrics-port": 9100})
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+    return harness
+
+
+@pytest.fixture
+def peer_id(harness):
+    harness.set_leader(True)
+    relation_id = harness.model.get_relation("cluster").id
+    harness.add_relation_unit(relation_id, PEER)
+    return relation_id
+
+
+def service(harness, name="gh-jira-bot-service"):
+    return harness.get_container_pebble_plan(CONTAINER).services[name]
+
+
+def stats(harness):
+    return harness.run_action("get-restart-stats").results
+
+
+def set_ready_check(monkeypatch, change_id="1", successes=None, status=ops.pebble.CheckStatus.UP):
+    check = ops.pebble.CheckInfo(
+        "gh-jira-bot-ready",
+        level="ready",
+        status=status,
+        successes=successes,
+        change_id=ops.pebble.ChangeID(change_id),
+    )
+    monkeypatch.setattr(ops.Container, "get_checks", lambda *_, **__: {check.name: check})
+
+
+def restart_state(harness, relation_id):
+    return harness.get_relation_data(relation_id, harness.charm.unit).get("restart", "")
+
+
+def test_unchanged_layer_skips_replan(harness):
+    before = stats(harness)
+    harness.charm.on.config_changed.emit()
+    after = stats(harness)
+    assert after["restarts"] == before["restarts"]
+    assert after["skipped-restarts"] == before["skipped-restarts"] + 1
+
+
+def test_changed_layer_replans(harness):
+    before = stats(harness)
+    harness.update_config({"bot-name": "bot"})
+    assert stats(harness)["restarts"] == before["restarts"] + 1
+    assert service(harness).environment["BOT_NAME"] == "bot"
+
+
+def test_pebble_ready_replans_unchanged_layer(harness):
+    before = stats(harness)
+    harness.container_pebble_ready(CONTAINER)
+    assert stats(harness)["restarts"] == before["restarts"] + 1
+
+
+def test_restart_waits_for_lock(harness, peer_id):
+    harness.update_relation_data(peer_id, PEER, {"restart": "requested"})
+    granted = json.loads(harness.get_relation_data(peer_id, harness.charm.app)["restart-granted"])
+    assert list(granted) == [PEER]
+
+    harness.update_config({"bot-name": "bot"})
+    assert harness.model.unit.status == ops.WaitingStatus("Waiting for restart lock")
+    assert "BOT_NAME" not in service(harness).environment
+
+    # The peer restarted and released the lock, which goes to this unit. Its ready check
+    # passes right away, so it restarts and releases the lock in the same hook.
+    harness.update_relation_data(peer_id, PEER, {"restart": ""})
+    assert service(harness).environment["BOT_NAME"] == "bot"
+    assert restart_state(harness, peer_id) == ""
+    assert isinstance(harness.model.unit.status, ops.ActiveStatus)
+    granted = json.loads(harness.get_relation_data(peer_id, harness.charm.app)["restart-granted"])
+    assert granted == {}
+
+
+def test_restart_waits_for_ready_check(harness, peer_id, clock, monkeypatch):
+    set_ready_check(monkeypatch, status=ops.pebble.CheckStatus.DOWN)
+    harness.update_config({"bot-name": "bot"})
+    assert service(harness).environment["BOT_NAME"] == "bot"
+    assert restart_state(harness, peer_id) == "restarting"
+    harness.charm.on.update_status.emit()
+    assert restart_state(harness, peer_id) == "restarting"
+
+    set_ready_check(monkeypatch)
+    harness.charm.on.update_status.emit()
+    assert restart_state(harness, peer_id) == ""
+
+
+@pytest.mark.parametrize(
+    "change_id, successes, ready",
+    [
+        ("1", 5, False),
+        ("1", 6, True),
+        # The check definition changed: Pebble restarted it, counting from zero.
+        ("2", 0, False),
+        ("2", 1, True),
+        ("1", 1, True),
+    ],
+)
+def test_restart_needs_check_success(
+    harness, peer_id, clock, monkeypatch, change_id, successes, ready
+):
+    set_ready_check(monkeypatch, "1", 5)
+    harness.update_config({"bot-name": "bot"})
+    assert restart_state(harness, peer_id) == "restarting"
+
+    set_ready_check(monkeypatch, change_id, successes)
+    harness.charm.on.update_status.emit()
+    assert restart_state(harness, peer_id) == ("" if ready else "restarting")
+
+
+def test_expired_restart_lock_is_revoked(harness, peer_id, clock):
+    harness.update_config({"restart-lock-timeout": 60})
+    harness.update_relation_data(peer_id, PEER, {"restart": "requested"})
+    harness.update_relation_data(peer_id, PEER, {"restart": "restarting"})
+    harness.update_config({"bot-name": "bot"})
+    assert harness.model.unit.status == ops.WaitingStatus("Waiting for restart lock")
+
+    clock.now += 120
+    harness.charm.on.update_status.emit()
+    assert "BOT_NAME" in service(harness).environment
+    granted = json.loads(harness.get_relation_data(peer_id, harness.charm.app)["restart-granted"])
+    assert PEER not in granted
+
+
+@pytest.mark.parametrize("config", [{"restart-lock-timeout": 0}, {"check-timeout": 10}])
+def test_invalid_restart_config_blocks(harness, config):
+    harness.update_config(config)
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_auto_workers_without_cpu_quota(harness):
+    harness.update_config({"workers": "auto"})
+    assert harness.model.unit.status == ops.ActiveStatus("workers: 2 (no CPU quota)")
+    assert "--workers=2" in service(harness).command
+
+
+def test_auto_workers_from_cgroup_quota(harness):
+    container = harness.model.unit.get_container(CONTAINER)
+    container.push("/sys/fs/cgroup/cpu.max", "250000 100000", make_dirs=True)
+    harness.update_config({"workers": "auto"})
+    assert harness.model.unit.status == ops.ActiveStatus("workers: 3")
+    assert "--workers=3" in service(harness).command
+
+
+@pytest.mark.parametrize("workers", ["0", "many"])
+def test_invalid_workers_blocks(harness, workers):
+    harness.update_config({"workers": workers})
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_credential_files_restored_after_container_restart(harness):
+    harness.update_config({"credentials-as-files": True})
+    container = harness.model.unit.get_container(CONTAINER)
+    assert service(harness).environment["JIRA_TOKEN_FILE"] == "/etc/gh-jira-bot/jira_token"
+    assert "JIRA_TOKEN" not in service(harness).environment
+
+    container.remove_path("/etc/gh-jira-bot/jira_token")
+    harness.container_pebble_ready(CONTAINER)
+    assert container.pull("/etc/gh-jira-bot/jira_token").read() == "jira-token"
+
+
+def test_credential_rotation_reloads_without_restart(harness):
+    harness.update_config({"credentials-as-files": True})
+    before = stats(harness)
+    harness.update_config({"jira-token": "rotated"})
+    container = harness.model.unit.get_container(CONTAINER)
+    assert container.pull("/etc/gh-jira-bot/jira_token").read() == "rotated"
+    after = stats(harness)
+    assert after["restarts"] == before["restarts"]
+    assert after["reloads"] == before["reloads"] + 1
+
+
+def test_credential_files_removed_when_disabled(harness):
+    harness.update_config({"credentials-as-files": True})
+    harness.update_config({"credentials-as-files": False})
+    container = harness.model.unit.get_container(CONTAINER)
+    assert not container.exists("/etc/gh-jira-bot/jira_token")
+    assert service(harness).environment["JIRA_TOKEN"] == "jira-token"
+
+
+def test_credential_files_kept_until_replan(harness, peer_id):
+    harness.update_config({"credentials-as-files": True})
+    harness.update_relation_data(peer_id, PEER, {"restart": "requested"})
+    harness.update_config({"credentials-as-files": False})
+    assert harness.model.unit.status == ops.WaitingStatus("Waiting for restart lock")
+    container = harness.model.unit.get_container(CONTAINER)
+    # The running service still reads the files until this unit gets the lock.
+    assert "JIRA_TOKEN_FILE" in service(harness).environment
+    assert container.exists("/etc/gh-jira-bot/jira_token")
+
+    harness.update_relation_data(peer_id, PEER, {"restart": ""})
+    assert "JIRA_TOKEN_FILE" not in service(harness).environment
+    assert not container.exists("/etc/gh-jira-bot/jira_token")
+
+
+class FakeClient:
+    """Kubernetes API holding the workload container's resources, applied to the pod at once."""
+
+    resources = ResourceRequirements()
+    patches: list = []
+
+    def __init__(self, field_manager):
+        self.field_manager = field_manager
+
+    def get(self, resource, name, namespace):
+        container = Container(name=CONTAINER, resources=self.resources)
+        if resource is Pod:
+            return Pod(spec=PodSpec(containers=[container]))
+        template = PodTemplateSpec(spec=PodSpec(containers=[container]))
+        return StatefulSet(
+            spec=StatefulSetSpec(selector=LabelSelector(), serviceName=name, template=template)
+        )
+
+    def patch(self, resource, name, namespace, obj, patch_type):
+        patch = obj["spec"]["template"]["spec"]["containers"][0]["resources"]
+        FakeClient.patches.append(patch)
+        FakeClient.resources = ResourceRequirements(
+            **{kind: {k: v for k, v in values.items() if v} for kind, values in patch.items()}
+        )
+
+
+@pytest.fixture
+def kubernetes(monkeypatch):
+    monkeypatch.setattr(FakeClient, "resources", ResourceRequirements())
+    monkeypatch.setattr(FakeClient, "patches", [])
+    monkeypatch.setattr(charm, "Client", FakeClient)
+    return FakeClient
+
+
+def test_resources_untouched_by_default(harness, monkeypatch):
+    monkeypatch.setattr(charm, "Client", None)
+    harness.update_config({"bot-name": "bot"})
+    assert harness.model.unit.status == ops.ActiveStatus("workers: 1")
+
+
+def test_resources_patched_by_leader(harness, kubernetes):
+    harness.set_leader(True)
+    harness.update_config({"cpu-request": "500m", "cpu-limit": "2"})
+    assert kubernetes.patches == [
+        {"requests": {"cpu": "500m", "memory": None}, "limits": {"cpu": "2", "memory": None}}
+    ]
+    assert harness.model.unit.status == ops.ActiveStatus("workers: 1, cpu: 500m/2, memory: -/-")
+
+    # Equal quantities written differently do not patch the StatefulSet again.
+    harness.update_config({"cpu-limit": "2000m"})
+    assert len(kubernetes.patches) == 1
+
+    harness.update_config({"cpu-request": "", "cpu-limit": ""})
+    assert kubernetes.patches[-1]["limits"] == {"cpu": None, "memory": None}
+
+
+def test_resources_not_patched_by_followers(harness, kubernetes):
+    harness.update_config({"memory-limit": "1Gi"})
+    assert kubernetes.patches == []
+    assert harness.model.unit.status == ops.ActiveStatus("workers: 1, cpu: -/-, memory: -/-")
+
+
+def test_resources_without_trust_blocks(harness, monkeypatch):
+    def untrusted(field_manager):
+        raise ConfigError("no kubeconfig")
+
+    monkeypatch.setattr(charm, "Client", untrusted)
+    harness.update_config({"cpu-limit": "2"})
+    assert "juju trust" in harness.model.unit.status.message
+
+
+@pytest.mark.parametrize(
+    "config",
+    [{"cpu-limit": "two"}, {"memory-request": "2Gi", "memory-limit": "1Gi"}],
+)
+def test_invalid_resources_block(harness, kubernetes, config):
+    harness.update_config(config)
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+    assert kubernetes.patches == []
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"metrics-port": 3000},
+        {"ingestion-mode": "queue"},
+        {"queue-max-length": 1000},
+        {"priority-lanes": "high:\n  share: 1\n  events: [issues]"},
+        {"fair-scheduling": "repository"},
+        {"server": "hypercorn"},
+        {"loop": "trio"},
+        {"health-check-path": "health"},
+        {"debounce-window": 5},
+    ],
+)
+def test_invalid_config_blocks(harness, config):
+    harness.update_config(config)
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"metrics-port": 0},
+        {"queue-max-length": -1},
+        {"queue-max-length": 1000},
+        {"queue-max-length": 1000, "shed-max-queue-depth": 1000},
+        {"priority-lanes": "1:\n  share: 1\n  events: [issues]\nb:\n  share: 1\n  events: [push]"},
+        {"priority-lanes": "a:\n  share: true\n  events: [issues]"},
+        {"priority-lanes": "default:\n  share: 2\n  events: [issues]"},
+        {"fair-scheduling": "installation", "repository-weights": "123: {weight: 1}\nb/c: {}"},
+        {"fair-scheduling": "repository", "repository-weights": "123: {weight: 1}\nb/c: {}"},
+        {"fair-scheduling": "repository", "repository-weights": "a/b: {weight: true}"},
+        {"fair-scheduling": "repository", "repository-weights": "[a/b]"},
+    ],
+)
+def test_invalid_queue_config_blocks(queue_harness, config):
+    queue_harness.update_config(config)
+    assert isinstance(queue_harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_queue_mode(queue_harness):
+    worker = service(queue_harness, "gh-jira-bot-worker")
+    assert worker.startup == "enabled"
+    assert "DELIVERY_STREAM_MAXLEN" not in worker.environment
+    metrics = service(queue_harness, "gh-jira-bot-metrics")
+    assert worker.environment["PROMETHEUS_MULTIPROC_DIR"] in metrics.command
+
+
+def test_queue_max_length_below_shedding(queue_harness):
+    queue_harness.update_config({"queue-max-length": 1000, "shed-max-queue-depth": 800})
+    environment = service(queue_harness, "gh-jira-bot-worker").environment
+    assert environment["DELIVERY_STREAM_MAXLEN"] == "1000"
+    assert service(queue_harness).environment["SHED_MAX_QUEUE_DEPTH"] == "800"
+
+
+def test_priority_lanes(queue_harness):
+    queue_harness.update_config(
+        {"priority-lanes": "high:\n  share: 3\n  events: [issues.opened, issue_comment]"}
+    )
+    lanes = json.loads(service(queue_harness).environment["PRIORITY_LANES"])
+    assert lanes == {
+        "high": {"share": 3, "events": ["issues.opened", "issue_comment"]},
+        "default": {"share": 1, "events": []},
+    }
+
+    queue_harness.update_config(
+        {
+            "priority-lanes": "high:\n  share: 3\n  events: [issues]\ndefault:\n  share: 2\n  events: []"
+        }
+    )
+    lanes = json.loads(service(queue_harness).environment["PRIORITY_LANES"])
+    assert lanes["default"] == {"share": 2, "events": []}
+
+
+def test_installation_weights_keys_are_strings(queue_harness):
+    queue_harness.update_config(
+        {"fair-scheduling": "installation", "repository-weights": "123: {weight: 2}"}
+    )
+    weights = json.loads(service(queue_harness).environment["REPOSITORY_WEIGHTS"])
+    assert weights == {"123": {"weight": 2}}
+
+
+def test_invalid_workload_json_fails_action(queue_harness):
+    queue_harness.handle_exec(
+        CONTAINER,
+        ["python3", "/etc/gh-jira-bot/redis_admin.py"],
+        result=ops.testing.ExecResult(stdout="Traceback (most recent call last):"),
+    )
+    with pytest.raises(ops.testing.ActionFailed) as e:
+        queue_harness.run_action("dead-letters-purge")
+    assert "invalid JSON" in e.value.message
+
+
+@pytest.mark.parametrize(
+    "ttl", ["{project: true}", "{project: -1}", "{epic: 60}", "[project]", "{project: ["]
+)
+def test_invalid_jira_metadata_ttl_blocks(harness, ttl):
+    harness.update_config({"jira-metadata-ttl": ttl})
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_jira_metadata_ttl(queue_harness):
+    assert "JIRA_METADATA_TTL" not in service(queue_harness).environment
+    queue_harness.update_config({"jira-metadata-ttl": "{project: 60, field: 0}"})
+    environment = service(queue_harness).environment
+    assert json.loads(environment["JIRA_METADATA_TTL"]) == {"project": 60}
+
+
+@pytest.fixture
+def ring_harness(queue_harness, peer_id, monkeypatch):
+    set_ready_check(monkeypatch)
+    commands = []
+
+    def handoff_reassign(args):
+        commands.append(args.command)
+        return ops.testing.ExecResult(stdout=json.dumps({"reassigned": {}}))
+
+    queue_harness.handle_exec(CONTAINER, ["python3", charm.REDIS_ADMIN], handler=handoff_reassign)
+    queue_harness.update_config({"ownership-vnodes": 2})
+    queue_harness.commands = commands
+    return queue_harness
+
+
+def hash_ring(harness):
+    container = harness.model.unit.get_container(CONTAINER)
+    return json.loads(container.pull(charm.HASH_RING_FILE).read())
+
+
+def test_hash_ring_members_are_serving_units(ring_harness, peer_id):
+    unit = ring_harness.charm.unit.name
+    ring = hash_ring(ring_harness)
+    assert ring["unit"] == unit
+    assert ring["points"] == sorted([charm.ring_hash(f"{unit}#{i}"), unit] for i in range(2))
+
+    ring_harness.update_relation_data(peer_id, PEER, {"serving": "true"})
+    members = {member for _, member in hash_ring(ring_harness)["points"]}
+    assert members == {unit, PEER}
+    assert json.loads(
+        ring_harness.get_relation_data(peer_id, ring_harness.charm.app)["ring-members"]
+    ) == sorted(members)
+
+
+def test_departed_unit_handoff_queue_reassigned(ring_harness, peer_id):
+    ring_harness.update_relation_data(peer_id, PEER, {"serving": "true"})
+    ring_harness.remove_relation_unit(peer_id, PEER)
+    command = ring_harness.commands[-1]
+    assert command[2] == "handoff-reassign"
+    assert f"--members={ring_harness.charm.unit.name}" in command
+    assert PEER not in {member for _, member in hash_ring(ring_harness)["points"]}
+
+
+def test_new_leader_reassigns_handoff_queues(ring_harness):
+    ring_harness.commands.clear()
+    ring_harness.set_leader(False)
+    ring_harness.set_leader(True)
+    members = ",".join(sorted([ring_harness.charm.unit.name, PEER]))
+    assert [command[3] for command in ring_harness.commands] == [f"--members={members}"]
+
+
+def test_handoff_reassign_failure_defers(ring_harness, peer_id):
+    ring_harness.handle_exec(
+        CONTAINER, ["python3", charm.REDIS_ADMIN], result=ops.testing.ExecResult(exit_code=1)
+    )
+    ring_harness.remove_relation_unit(peer_id, PEER)
+    deferred = [path for path, _, _ in ring_harness.framework._storage.notices()]
+    assert any("cluster_relation_departed" in path for path in deferred)
+
+
+@pytest.fixture
+def autoscaling(queue_harness, clock):
+    stream = {"backlog": 0, "oldest-age": 0.0}
+
+    def stream_stats(args):
+        assert args.command[2:] == ["stream-stats", "--group=charmed-github-jira-bot-workers"]
+        return ops.testing.ExecResult(stdout=json.dumps(stream))
+
+    queue_harness.handle_exec(CONTAINER, ["python3", charm.REDIS_ADMIN], handler=stream_stats)
+    queue_harness.set_leader(True)
+    queue_harness.set_planned_units(2)
+    queue_harness.update_config({"autoscale-max-units": 5, "autoscale-cooldown": 600})
+    return stream
+
+
+def recommended_units(harness):
+    harness.charm.on.update_status.emit()
+    return harness.run_action("get-scaling-recommendation").results["recommended-units"]
+
+
+def test_autoscaling_recommendation(queue_harness, autoscaling, clock):
+    autoscaling.update(backlog=450, **{"oldest-age": 5.0})
+    assert recommended_units(queue_harness) == 5
+    assert queue_harness.model.app.status == ops.ActiveStatus(
+        "recommended units: 5 (backlog 450, oldest 5s)"
+    )
+
+    # Scaling down waits for the cooldown, then goes one unit at a time.
+    autoscaling.update(backlog=0)
+    assert recommended_units(queue_harness) == 5
+    clock.now += 600
+    assert recommended_units(queue_harness) == 1
+    autoscaling.update(**{"oldest-age": 60.0})
+    clock.now += 600
+    assert recommended_units(queue_harness) == 3
+
+
+def test_disabling_autoscaling_clears_app_status(queue_harness, autoscaling):
+    queue_harness.charm.on.update_status.emit()
+    assert queue_harness.model.app.status.message.startswith("recommended units")
+    queue_harness.update_config({"autoscale-max-units": 0})
+    assert queue_harness.model.app.status == ops.ActiveStatus()
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"autoscale-min-units": 6},
+        {"scale-down-backlog": 100},
+        {"scale-up-age": 0},
+        {"ingestion-mode": "sync"},
+    ],
+)
+def test_invalid_autoscaling_config_blocks(queue_harness, autoscaling, config):
+    queue_harness.update_config(config)
+    assert isinstance(queue_harness.model.unit.status, ops.BlockedStatus)
+
+
+@pytest.mark.parametrize(
+    "action, params",
+    [("dead-letters-list", {"limit": 0}), ("dead-letters-requeue", {"count": -1})],
+)
+def test_invalid_dead_letters_params_fail_action(queue_harness, action, params):
+    with pytest.raises(ops.testing.ActionFailed):
+        queue_harness.run_action(action, params)
+
+
+def test_gunicorn_config_pushed(harness):
+    harness.update_config({"server": "gunicorn"})
+    container = harness.model.unit.get_container(CONTAINER)
+    assert container.pull(charm.GUNICORN_CONFIG).read() == charm.GUNICORN_CONFIG_SOURCE.read_text()
+    assert f"--config={charm.GUNICORN_CONFIG}" in service(harness).command
+
+
+def test_metrics_server_pushed(harness):
+    harness.update_config({"metrics-port": 9100})
+    container = harness.model.unit.get_container(CONTAINER)
+    assert container.pull(charm.METRICS_SERVER).read() == charm.METRICS_SERVER_SOURCE.read_text()
+    metrics = service(harness, "gh-jira-bot-metrics")
+    assert metrics.command.startswith(f"python3 {charm.METRICS_SERVER} 9100 ")
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"dedup-ttl": -1},
+        {"dedup-ttl": 60},
+        {"token-cache-margin": 300},
+        {"token-cache-margin": 3600},
+        {"local-cache-max-entries": 100},
+        {"local-cache-max-mb": 0},
+    ],
+)
+def test_invalid_redis_config_blocks(harness, config):
+    harness.update_config(config)
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_delivery_deduplication(queue_harness):
+    assert "DELIVERY_DEDUP_TTL" not in service(queue_harness).environment
+    queue_harness.update_config({"dedup-ttl": 3600})
+    assert service(queue_harness).environment["DELIVERY_DEDUP_TTL"] == "3600"
+
+
+def test_installation_token_cache(queue_harness):
+    assert "INSTALLATION_TOKEN_CACHE_TTL" not in service(queue_harness).environment
+    queue_harness.update_config({"token-cache-margin": 300})
+    assert service(queue_harness).environment["INSTALLATION_TOKEN_CACHE_TTL"] == "3300"
+
+
+def test_sync_config_cache(harness):
+    assert "SYNC_CONFIG_MAX_AGE" not in service(harness).environment
+    harness.update_config({"sync-config-max-age": 300})
+    assert service(harness).environment["SYNC_CONFIG_MAX_AGE"] == "300"
+    harness.update_config({"sync-config-max-age": -1})
+    assert isinstance(harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_issue_key_index_requires_image_module(queue_harness):
+    assert "ISSUE_KEY_INDEX_KEY" not in service(queue_harness).environment
+    queue_harness.update_config({"issue-key-index": True})
+    assert "ISSUE_KEY_INDEX_KEY" in service(queue_harness).environment
+
+    queue_harness.handle_exec(CONTAINER, ["python3", "-c"], result=1)
+    queue_harness.update_config({"issue-key-index": False})
+    queue_harness.update_config({"issue-key-index": True})
+    assert queue_harness.model.unit.status == ops.BlockedStatus(
+        "github_jira_sync_app.issue_index is not available in the OCI image"
+    )
+
+
+def test_local_cache(queue_harness):
+    assert "LOCAL_CACHE_MAX_ENTRIES" not in service(queue_harness).environment
+    queue_harness.update_config({"local-cache-max-entries": 100, "local-cache-max-mb": 16})
+    environment = service(queue_harness).environment
+    assert environment["LOCAL_CACHE_MAX_ENTRIES"] == "100"
+    assert environment["LOCAL_CACHE_MAX_BYTES"] == str(16 * 2**20)
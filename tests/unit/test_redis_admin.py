@@ -0,0 +1,133 @@
+import argparse
+import json
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+import redis_admin
+from charm import ring_hash
+
+PREFIX = "bot:"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("REDIS_KEY_PREFIX", PREFIX)
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def ring(tmp_path):
+    points = sorted(
+        [ring_hash(f"{unit}#{i}"), unit] for unit in ("bot/0", "bot/1") for i in range(4)
+    )
+    path = tmp_path / "hash-ring.json"
+    path.write_text(json.dumps({"unit": "bot/0", "hash": "sha256-64", "points": points}))
+    return path
+
+
+def owner(ring, repository):
+    points = json.loads(ring.read_text())["points"]
+    for position, unit in points:
+        if position >= ring_hash(repository):
+            return unit
+    return points[0][1]
+
+
+def test_handoff_reassign_empties_queues_of_departed_units(client, ring):
+    repositories = [f"org/repo-{i}" for i in range(20)]
+    for repository in repositories:
+        client.rpush(f"{PREFIX}handoff:bot/2", json.dumps({"repository": repository}))
+    client.rpush(f"{PREFIX}handoff:bot/2", "not json")
+    client.rpush(f"{PREFIX}handoff:bot/1", json.dumps({"repository": "org/kept"}))
+
+    args = argparse.Namespace(members="bot/0,bot/1", ring=str(ring), fallback="bot/0")
+    assert redis_admin.handoff_reassign(client, args) == {"reassigned": {"bot/2": 21}}
+
+    assert not client.exists(f"{PREFIX}handoff:bot/2")
+    queued = {
+        unit: [entry.decode() for entry in client.lrange(f"{PREFIX}handoff:{unit}", 0, -1)]
+        for unit in ("bot/0", "bot/1")
+    }
+    for repository in repositories:
+        assert json.dumps({"repository": repository}) in queued[owner(ring, repository)]
+    assert "not json" in queued["bot/0"]
+    assert queued["bot/1"][0] == json.dumps({"repository": "org/kept"})
+
+
+def test_handoff_reassign_skips_owners_not_members(client, ring):
+    client.rpush(f"{PREFIX}handoff:bot/1", json.dumps({"repository": "org/repo"}))
+    # bot/1 departed but the ring was not updated yet: everything goes to the fallback.
+    args = argparse.Namespace(members="bot/0", ring=str(ring), fallback="bot/0")
+    assert redis_admin.handoff_reassign(client, args) == {"reassigned": {"bot/1": 1}}
+    assert client.llen(f"{PREFIX}handoff:bot/0") == 1
+
+
+@pytest.fixture
+def stream(client, monkeypatch):
+    monkeypatch.setattr(redis_admin, "time", SimpleNamespace(time=lambda: 100.0))
+    for second in range(10, 60, 10):
+        client.xadd(f"{PREFIX}deliveries", {"delivery": second}, id=f"{second * 1000}-0")
+    return f"{PREFIX}deliveries"
+
+
+def stream_stats(client, group="workers"):
+    return redis_admin.stream_stats(client, argparse.Namespace(group=group))
+
+
+def test_stream_stats_without_stream(client):
+    assert stream_stats(client) == {"backlog": 0, "oldest-age": 0}
+
+
+def test_stream_stats_before_any_consumer(client, stream):
+    assert stream_stats(client) == {"backlog": 5, "oldest-age": 90.0}
+
+
+def test_stream_stats_counts_pending_and_undelivered(client, stream):
+    client.xgroup_create(stream, "workers", id="0")
+    read = client.xreadgroup("workers", "unit-0", {stream: ">"}, count=2)
+    client.xack(stream, "workers", read[0][1][0][0])
+    # One delivery in flight, the 20s one, and three never delivered.
+    assert stream_stats(client) == {"backlog": 4, "oldest-age": 80.0}
+
+    client.xack(stream, "workers", read[0][1][1][0])
+    assert stream_stats(client) == {"backlog": 3, "oldest-age": 70.0}
+
+
+def test_undelivered_counted_without_stream_counters(client, stream, monkeypatch):
+    monkeypatch.setattr(redis_admin, "STREAM_STATS_MAX_COUNT", 2)
+    monkeypatch.setattr(client, "xinfo_stream", lambda _: {})
+    assert redis_admin._undelivered(client, stream, {}, "20000-0") == 2
+    assert redis_admin._undelivered(client, stream, {}, "40000-0") == 1
+
+
+@pytest.fixture
+def dead_letters(client):
+    entries = [json.dumps({"delivery": str(i), "attempts": 5}) for i in range(5)]
+    client.rpush(f"{PREFIX}dead-letters", *entries)
+    return entries
+
+
+def test_dead_letters_list(client, dead_letters):
+    listed = redis_admin.dead_letters_list(client, argparse.Namespace(limit=2))
+    assert listed == {"count": 5, "entries": dead_letters[:2]}
+
+
+@pytest.mark.parametrize("count, batch", [(0, 2), (0, 1000), (3, 2)])
+def test_dead_letters_requeue(client, dead_letters, monkeypatch, count, batch):
+    monkeypatch.setattr(redis_admin, "REQUEUE_BATCH", batch)
+    monkeypatch.setattr(redis_admin, "time", SimpleNamespace(time=lambda: 100.0))
+    # Already scheduled again, e.g. by a redelivery: merged rather than duplicated.
+    client.zadd(f"{PREFIX}retries", {dead_letters[0]: 50.0})
+
+    requeued = count or len(dead_letters)
+    args = argparse.Namespace(count=count)
+    assert redis_admin.dead_letters_requeue(client, args) == {"requeued": requeued, "merged": 1}
+
+    remaining = [entry.decode() for entry in client.lrange(f"{PREFIX}dead-letters", 0, -1)]
+    assert remaining == dead_letters[requeued:]
+    retries = client.zrange(f"{PREFIX}retries", 0, -1, withscores=True)
+    assert [(entry.decode(), score) for entry, score in retries] == [
+        (entry, 100.0) for entry in dead_letters[:requeued]
+    ]